@@ -28,6 +28,7 @@ from .condominium import *
 from .configuration import *
 from .party import *
 from .payment import *
+from . import routes
 
 
 def register():
@@ -38,16 +39,29 @@ def register():
         CheckMandatesList,
         Company,
         CondoPain,
+        CondoPainPart,
         CondoParty,
+        FeeRunStart,
         Group,
         GroupConfiguration,
+        ImportStatusReportStart,
         Mandate,
         MandateConfiguration,
         Party,
         Payment,
+        ReconcileStatementsResult,
+        ReconcileStatementsStart,
         Unit,
         module='condominium_payment_sepa',
         type_='model',
     )
     Pool.register(MandateReport, module='condominium_payment_sepa', type_='report')
-    Pool.register(CheckMandates, PartyReplace, module='condominium_payment_sepa', type_='wizard')
+    Pool.register(
+        CheckMandates,
+        FeeRun,
+        ImportStatusReport,
+        PartyReplace,
+        ReconcileStatements,
+        module='condominium_payment_sepa',
+        type_='wizard',
+    )
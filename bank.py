@@ -46,6 +46,12 @@ class Bank(metaclass=PoolMeta):
         help=('Country Extended Character Set'),
         states={'invisible': Not(Bool(Eval('subset')))},
     )
+    max_transactions = fields.Integer(
+        'Maximum Transactions', help=('Maximum number of transactions by direct debit message, no limit if empty')
+    )
+    max_message_size = fields.Integer(
+        'Maximum Message Size (KB)', help=('Maximum size of the direct debit messages, no limit if empty')
+    )
 
     @staticmethod
     def default_subset():
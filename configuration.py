@@ -20,15 +20,49 @@
 ##############################################################################
 
 
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
 
 
 __all__ = ['GroupConfiguration', 'MandateConfiguration']
 
 
-class GroupConfiguration(ModelSingleton, ModelSQL, ModelView):
+class DefaultsCacheMixin(object):
+    'Cache the values of _defaults_fields of the singleton until it is modified'
+    _defaults_fields = []
+
+    @classmethod
+    def get_defaults(cls):
+        'Return a dictionary with the value of each field of _defaults_fields'
+        defaults = cls._defaults_cache.get(None)
+        if defaults is None:
+            config = cls(1)
+            defaults = {name: getattr(config, name) for name in cls._defaults_fields}
+            cls._defaults_cache.set(None, defaults)
+        return defaults.copy()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(DefaultsCacheMixin, cls).create(vlist)
+        cls._defaults_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(DefaultsCacheMixin, cls).write(*args)
+        cls._defaults_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(DefaultsCacheMixin, cls).delete(records)
+        cls._defaults_cache.clear()
+
+
+class GroupConfiguration(DefaultsCacheMixin, ModelSingleton, ModelSQL, ModelView):
     'Condominium Payment Group Configuration'
     __name__ = 'condo.payment.group.configuration'
+    _defaults_cache = Cache('condo.payment.group.configuration', context=False)
+    _defaults_fields = ['sepa_batch_booking_selection', 'sepa_charge_bearer']
 
     sepa_batch_booking_selection = fields.Selection(
         [(None, ''), ('1', 'Batch'), ('0', 'Per Transaction')], 'Default Booking', sort=False
@@ -41,9 +75,11 @@ class GroupConfiguration(ModelSingleton, ModelSQL, ModelView):
     )
 
 
-class MandateConfiguration(ModelSingleton, ModelSQL, ModelView):
+class MandateConfiguration(DefaultsCacheMixin, ModelSingleton, ModelSQL, ModelView):
     'Condominium SEPA Mandate Configuration'
     __name__ = 'condo.payment.sepa.mandate.configuration'
+    _defaults_cache = Cache('condo.payment.sepa.mandate.configuration', context=False)
+    _defaults_fields = ['type', 'scheme']
 
     type = fields.Selection([('recurrent', 'Recurrent'), ('one-off', 'One-off')], 'Type', sort=False)
     scheme = fields.Selection([('CORE', 'Core'), ('B2B', 'Business to Business')], 'Scheme', sort=False)
@@ -19,31 +19,67 @@
 #
 ##############################################################################
 
+import csv
 import datetime
+import gzip
 import os
+import shutil
+import sqlite3
+import tempfile
 import unicodedata
-from itertools import groupby, chain
+import zipfile
+import zlib
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+from functools import partial
+from io import BytesIO, StringIO
+from itertools import groupby, chain, islice
 
 import genshi
 import genshi.template
-from sql import Column, Literal
-from sql.aggregate import Count, Max
-
+from lxml import etree
+from sql import Column, For, Literal, Null
+from stdnum import iban
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.filestore import filestore
 from trytond.pool import Pool
 from trytond.model import ModelSQL, ModelView, Workflow, fields, dualmethod, Unique
-from trytond.pyson import Eval, If, Not, Bool
+from trytond.pyson import Eval, If, Not, Bool, PYSONEncoder
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 from trytond.tools import reduce_ids, grouped_slice
-from trytond.wizard import Wizard, StateTransition, StateView, Button
+from trytond.wizard import Wizard, StateAction, StateTransition, StateView, Button
 
 from trytond.modules.company import CompanyReport
 
-from . import sepadecode
+from . import sepadecode, sepahandler, sepawriter
 
 EPC_COUNTRIES = list(sepadecode._countries)
 
 
-__all__ = ['CondoPain', 'Group', 'Payment', 'Mandate', 'MandateReport', 'CheckMandatesList', 'CheckMandates']
+__all__ = [
+    'CondoPain',
+    'CondoPainPart',
+    'Group',
+    'Payment',
+    'Mandate',
+    'MandateReport',
+    'CheckMandatesList',
+    'CheckMandates',
+    'ImportStatusReportStart',
+    'ImportStatusReport',
+    'ReconcileStatementsStart',
+    'ReconcileStatementsResult',
+    'ReconcileStatements',
+    'FeeRunStart',
+    'FeeRun',
+]
 
 # XXX fix: https://genshi.edgewall.org/ticket/582
 from genshi.template.astutil import ASTCodeGenerator, ASTTransformer
@@ -66,7 +102,112 @@ if not hasattr(ASTTransformer, 'visit_NameConstant'):
     ASTTransformer.visit_NameConstant = ASTTransformer.visit_Name
 
 
-class CondoPain(Workflow, ModelSQL, ModelView):
+class MessageMixin(object):
+    '''Store the message gzip compressed in the filestore
+
+    The message is a lazy function field so browsing the records does not
+    read it.
+    '''
+    message_data = fields.Binary('Message Data', file_id='message_file_id', readonly=True)
+    message_file_id = fields.Char('Message File ID', readonly=True)
+    sepa_message_id = fields.Char('SEPA Message ID', readonly=True, select=True, help='MsgId of the message sent')
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        exist = TableHandler.table_exist(cls._table)
+        migrate = exist and cls.__table_handler__(module_name).column_exist('message')
+        add_message_id = exist and not cls.__table_handler__(module_name).column_exist('sepa_message_id')
+
+        # Migration from message_id
+        if exist:
+            cls.__table_handler__(module_name).column_rename('message_id', 'message_file_id')
+
+        super(MessageMixin, cls).__register__(module_name)
+
+        # Migration from the message stored in a text column
+        if migrate:
+            prefix = cls.get_message_prefix()
+            cursor.execute(*table.select(table.id, where=table.message != Null))
+            for (record_id,) in cursor.fetchall():
+                cursor.execute(*table.select(table.message, where=table.id == record_id))
+                (message,) = cursor.fetchone()
+                cursor.execute(
+                    *table.update(
+                        columns=[table.message_file_id],
+                        values=[filestore.set(compress_message(message), prefix=prefix)],
+                        where=table.id == record_id,
+                    )
+                )
+            cls.__table_handler__(module_name).drop_column('message')
+
+        # Read the MsgId of the messages generated before it was stored
+        if add_message_id:
+            prefix = cls.get_message_prefix()
+            cursor.execute(*table.select(table.id, table.message_file_id, where=table.message_file_id != Null))
+            for record_id, file_id in cursor.fetchall():
+                try:
+                    with gzip.GzipFile(fileobj=BytesIO(filestore.get(file_id, prefix=prefix))) as source:
+                        message_id = sepahandler.read_message_id(source)
+                except etree.XMLSyntaxError:
+                    continue
+                cursor.execute(
+                    *table.update(columns=[table.sepa_message_id], values=[message_id], where=table.id == record_id)
+                )
+
+    @classmethod
+    def get_message_prefix(cls):
+        'Return the filestore prefix of the messages'
+        return cls.message_data.store_prefix or Transaction().database.name
+
+    @classmethod
+    def get_message(cls, records, name):
+        return {r.id: decompress_message(r.message_data) for r in records}
+
+    @classmethod
+    def set_message(cls, records, name, value):
+        cls.write(records, {'message_data': compress_message(value)})
+
+    def iter_message(self, size=64 * 1024):
+        'Yield the message encoded in UTF-8 by chunks of at most size bytes'
+        return iter_decompress_message(self.message_data, size)
+
+
+def compress_message(message):
+    if message:
+        return gzip.compress(message.encode('utf-8'))
+
+
+def compress_message_file(source, size=64 * 1024):
+    'Return the gzip compressed data of the UTF-8 message read from the binary file source by chunks'
+    sink = BytesIO()
+    with gzip.GzipFile(fileobj=sink, mode='wb') as compressed:
+        shutil.copyfileobj(source, compressed, size)
+    return sink.getvalue()
+
+
+def decompress_message(data):
+    if data:
+        return gzip.decompress(data).decode('utf-8')
+
+
+def iter_decompress_message(data, size=64 * 1024):
+    'Yield the compressed message data decompressed by chunks of at most size bytes'
+    if not data:
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = bytes(data)
+    while not decompressor.eof:
+        chunk = decompressor.decompress(data, size)
+        data = decompressor.unconsumed_tail
+        if not chunk and not data:
+            break
+        yield chunk
+
+
+class CondoPain(MessageMixin, Workflow, ModelSQL, ModelView):
     'Condominium Payment Initation Message'
     __name__ = 'condo.payment.pain'
     reference = fields.Char(
@@ -117,9 +258,19 @@ class CondoPain(Workflow, ModelSQL, ModelView):
         depends=['bank', 'company', 'state'],
         states={'readonly': Eval('state') != 'draft'},
     )
-    message = fields.Text('Message', states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    message = fields.Function(
+        fields.Text('Message', states={'readonly': Eval('state') != 'draft'}, depends=['state']),
+        'get_message',
+        setter='set_message',
+    )
     state = fields.Selection(
-        [('draft', 'Draft'), ('generated', 'Generated'), ('booked', 'Booked'), ('rejected', 'Rejected')],
+        [
+            ('draft', 'Draft'),
+            ('generating', 'Generating'),
+            ('generated', 'Generated'),
+            ('booked', 'Booked'),
+            ('rejected', 'Rejected'),
+        ],
         'State',
         select=True,
     )
@@ -137,16 +288,38 @@ class CondoPain(Workflow, ModelSQL, ModelView):
         help=('Country Extended Character Set'),
         states={'readonly': Eval('state') != 'draft', 'invisible': Not(Bool(Eval('subset')))},
     )
-    nboftxs = fields.Function(fields.Integer('Number of Transactions'), 'get_nboftxs')
-    ctrlsum = fields.Function(fields.Numeric('Control Sum', digits=(11, 2)), 'get_ctrlsum')
+    nboftxs = fields.Integer('Number of Transactions', readonly=True, select=True)
+    ctrlsum = fields.Numeric('Control Sum', digits=(11, 2), readonly=True, select=True)
+    generated_nboftxs = fields.Integer(
+        'Rendered Transactions', readonly=True, help='Transactions already rendered by the background generation'
+    )
+    generation_error = fields.Text('Generation Error', readonly=True)
+    parts = fields.One2Many(
+        'condo.payment.pain.part',
+        'pain',
+        'Split Messages',
+        readonly=True,
+        help='Messages sent instead of Message when the limits of the bank are exceeded',
+    )
 
     @classmethod
     def __setup__(cls):
         super(CondoPain, cls).__setup__()
-        cls._error_messages.update({'generate_error': ('Can not generate message "%s" of "%s"')})
+        cls._error_messages.update(
+            {
+                'generate_error': ('Can not generate message "%s" of "%s"'),
+                'invalid_message': ('Message "%s" is not valid: %s'),
+                'import_not_booked': ('Message "%s" must be sent to bank to import its status report.'),
+                'invalid_status_report': ('Status report is not valid: %s'),
+                'unknown_status_report': ('Status report of message "%s" is not about message "%s".'),
+            }
+        )
         cls._transitions |= set(
             (
+                ('draft', 'generating'),
                 ('draft', 'generated'),
+                ('generating', 'generated'),
+                ('generating', 'draft'),
                 ('generated', 'draft'),
                 ('generated', 'booked'),
                 ('generated', 'rejected'),
@@ -157,8 +330,9 @@ class CondoPain(Workflow, ModelSQL, ModelView):
         cls._buttons.update(
             {
                 'cancel': {'invisible': ~Eval('state').in_(['generated', 'booked'])},
-                'draft': {'invisible': ~Eval('state').in_(['generated', 'rejected'])},
+                'draft': {'invisible': ~Eval('state').in_(['generating', 'generated', 'rejected'])},
                 'generate': {'invisible': Eval('state') != 'draft'},
+                'queue_generation': {'invisible': Eval('state') != 'draft'},
                 'accept': {'invisible': Eval('state') != 'generated'},
             }
         )
@@ -217,15 +391,35 @@ class CondoPain(Workflow, ModelSQL, ModelView):
                 self.subset = bank.subset
                 self.country_subset = bank.country_subset
 
-    def get_nboftxs(self, name):
-        if self.groups:
-            # http://stackoverflow.com/questions/952914/making-a-flat-list-out-of-list-of-lists-in-python?rq=1
-            # leaf for tree in forest for leaf in tree
-            return sum(1 for group in self.groups for p in group.payments if p.amount)
+    @classmethod
+    def create(cls, vlist):
+        pains = super(CondoPain, cls).create(vlist)
+        cls.update_totals(pains)
+        return pains
 
-    def get_ctrlsum(self, name):
-        if self.groups:
-            return sum(p.amount for group in self.groups for p in group.payments if p.amount)
+    @classmethod
+    def update_totals(cls, pains=None):
+        'Update the stored totals of the pains from the ones of their groups'
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        table = cls.__table__()
+        group = Group.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # pains without groups have no totals, groups without payments count as 0
+        nboftxs = group.select(Sum(Coalesce(group.nboftxs, 0)), where=group.pain == table.id)
+        ctrlsum = group.select(Sum(Coalesce(Group.ctrlsum.sql_column(group), 0)), where=group.pain == table.id)
+        if pains is None:
+            cursor.execute(*table.update(columns=[table.nboftxs, table.ctrlsum], values=[nboftxs, ctrlsum]))
+            _clear_cache(cls)
+            return
+        pain_ids = [p.id for p in pains]
+        for sub_ids in grouped_slice(pain_ids):
+            red_sql = reduce_ids(table.id, sub_ids)
+            cursor.execute(
+                *table.update(columns=[table.nboftxs, table.ctrlsum], values=[nboftxs, ctrlsum], where=red_sql)
+            )
+        _clear_cache(cls, pain_ids)
 
     def sepa_group_payment_key(self, payment):
         key = (('date', payment.date),)
@@ -234,89 +428,783 @@ class CondoPain(Workflow, ModelSQL, ModelView):
         key += (('scheme', payment.mandate.scheme),)
         return key
 
-    @property
-    def sepa_payments(self):
+    def sepa_payments(self, pain):
+        'Yield the payment information keys of the snapshot pain with their payments'
         keyfunc = self.sepa_group_payment_key
-        payments = sorted([payment for group in self.groups for payment in group.payments], key=keyfunc)
-        for key, grouped_payments in groupby(payments, key=keyfunc):
-            yield dict(key), list(grouped_payments)
+        # The payments come ordered by key from the database
+        for key, grouped_payments in groupby(self.sepa_payment_stream(pain), key=keyfunc):
+            yield dict(key), grouped_payments
+
+    def get_sepa_batch_plan(self, pain):
+        'Return the payment information blocks of the snapshot pain with their totals'
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        Payment = pool.get('condo.payment')
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        mandate = Mandate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(
+            *payment.join(group, condition=payment.group == group.id)
+            .join(mandate, condition=payment.mandate == mandate.id)
+            .select(
+                payment.date,
+                payment.group,
+                payment.type,
+                mandate.scheme,
+                Count(Literal('*')),
+                Sum(Payment.amount.sql_column(payment)),
+                where=group.pain == self.id,
+                group_by=[payment.date, payment.group, payment.type, mandate.scheme],
+            )
+        )
+        totals = {}
+        for date, group_id, type_, scheme, nboftxs, ctrlsum in cursor.fetchall():
+            if not isinstance(ctrlsum, Decimal):
+                # SQLite sums numeric as float
+                ctrlsum = Decimal(str(ctrlsum)).quantize(Decimal('0.01'))
+            totals[(date, group_id, type_, scheme)] = (nboftxs, ctrlsum)
+
+        def batches():
+            for key, payments in self.sepa_payments(pain):
+                first = next(payments)
+                nboftxs, ctrlsum = totals[(first.date, first.group.id, first.type, first.mandate.scheme)]
+                yield SepaBatch(key, chain([first], payments), nboftxs, ctrlsum)
+
+        return SepaBatchPlan(
+            batches(), sum(t[0] for t in totals.values()), sum((t[1] for t in totals.values()), Decimal(0))
+        )
+
+    def get_message_files(self):
+        '''Return the file names of the generated messages with their filestore id and prefix
+
+        The compressed messages are read with filestore.get so they can be
+        read one by one.
+        '''
+        name = self.reference.replace('/', '-')
+        prefix = self.get_message_prefix()
+        if self.parts:
+            return [('%s-%s.xml' % (name, part.sequence), part.message_file_id, prefix) for part in self.parts]
+        elif self.message_file_id:
+            return [('%s.xml' % name, self.message_file_id, prefix)]
+        return []
 
     def get_sepa_template(self):
         if self.sepa_receivable_flavor:
             return loader.load('%s.xml' % self.sepa_receivable_flavor)
 
+    def get_sepa_snapshot(self):
+        'Return a read-only snapshot of the pain and its groups'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Company = pool.get('company.company')
+        Group = pool.get('condo.payment.group')
+        Currency = pool.get('currency.currency')
+        Bank = pool.get('bank')
+        BankAccount = pool.get('bank.account')
+        BankAccountNumber = pool.get('bank.account.number')
+        group = Group.__table__()
+        company = Company.__table__()
+        party = Party.__table__()
+        number = BankAccountNumber.__table__()
+        account = BankAccount.__table__()
+        bank = Bank.__table__()
+        bank_party = Party.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(
+            *group.join(company, condition=group.company == company.id)
+            .join(party, condition=company.party == party.id)
+            .join(number, condition=group.account_number == number.id)
+            .join(account, condition=number.account == account.id)
+            .join(bank, condition=account.bank == bank.id)
+            .join(bank_party, condition=bank.party == bank_party.id)
+            .join(currency, 'LEFT', condition=account.currency == currency.id)
+            .select(
+                group.id,
+                group.reference,
+                group.date,
+                group.sepa_batch_booking,
+                group.sepa_charge_bearer,
+                company.id,
+                company.sepa_creditor_identifier,
+                party.id,
+                party.name,
+                *_sepa_account_number_columns(number, bank, bank_party, currency),
+                where=group.pain == self.id,
+                order_by=group.id,
+            )
+        )
+        groups = OrderedDict()
+        companies = {}
+        for row in cursor.fetchall():
+            group_id, reference, date, batch_booking, charge_bearer, company_id, identifier, party_id, name = row[:9]
+            if company_id not in companies:
+                companies[company_id] = SepaCompany(company_id, SepaParty(party_id, name), identifier)
+            groups[group_id] = SepaGroup(
+                group_id,
+                reference,
+                companies[company_id],
+                _sepa_account_number(row[9:]),
+                date,
+                batch_booking,
+                charge_bearer,
+            )
+
+        company = self.company
+        return SepaPain(
+            self.id,
+            self.reference,
+            SepaCompany(company.id, SepaParty(company.party.id, company.party.name), company.sepa_creditor_identifier),
+            groups,
+            self.subset,
+            self.country_subset,
+        )
+
+    def sepa_payment_stream(self, pain):
+        '''Yield the payments of the snapshot pain ordered by payment information key
+
+        The rows are fetched by chunks (from a server-side cursor on
+        PostgreSQL) so the payments are never all held in memory.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Group = pool.get('condo.payment.group')
+        Payment = pool.get('condo.payment')
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        Unit = pool.get('condo.unit')
+        Currency = pool.get('currency.currency')
+        Bank = pool.get('bank')
+        BankAccount = pool.get('bank.account')
+        BankAccountNumber = pool.get('bank.account.number')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        mandate = Mandate.__table__()
+        party = Party.__table__()
+        currency = Currency.__table__()
+        unit = Unit.__table__()
+        number = BankAccountNumber.__table__()
+        account = BankAccount.__table__()
+        bank = Bank.__table__()
+        bank_party = Party.__table__()
+        number_currency = Currency.__table__()
+        transaction = Transaction()
+        if backend.name() == 'postgresql':
+            cursor = transaction.connection.cursor('condo_payment_pain_%s' % self.id)
+        else:
+            cursor = transaction.connection.cursor()
+
+        if pain.subset:
+            convert = partial(sepadecode.sepa_conversions, pain.country_subset.code if pain.country_subset else None)
+        else:
+            convert = None
+        # The sequence types sort as the payment types they come from
+        query = (
+            payment.join(group, condition=payment.group == group.id)
+            .join(mandate, condition=payment.mandate == mandate.id)
+            .join(party, condition=mandate.party == party.id)
+            .join(number, condition=mandate.account_number == number.id)
+            .join(account, condition=number.account == account.id)
+            .join(bank, condition=account.bank == bank.id)
+            .join(bank_party, condition=bank.party == bank_party.id)
+            .join(number_currency, 'LEFT', condition=account.currency == number_currency.id)
+            .join(currency, 'LEFT', condition=payment.currency == currency.id)
+            .join(unit, 'LEFT', condition=payment.unit == unit.id)
+            .select(
+                payment.id,
+                payment.group,
+                payment.amount,
+                currency.id,
+                currency.code,
+                payment.date,
+                payment.type,
+                payment.sepa_end_to_end_id,
+                payment.description,
+                mandate.id,
+                mandate.identification,
+                mandate.signature_date,
+                mandate.scheme,
+                party.id,
+                party.name,
+                *_sepa_account_number_columns(number, bank, bank_party, number_currency),
+                where=group.pain == self.id,
+                order_by=[payment.date, payment.group, payment.type, mandate.scheme, unit.name, payment.id],
+            )
+        )
+        size = config.getint('condominium_payment_sepa', 'fetch_size', default=1000)
+        # SQLite can not commit the progress while the payments are read
+        progress = transaction.context.get('sepa_generation_progress') and backend.name() != 'sqlite'
+        count = 0
+        try:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                if convert:
+                    texts = convert(chain.from_iterable((r[7], r[8], r[14]) for r in rows))
+                else:
+                    texts = None
+                for row in rows:
+                    (
+                        payment_id,
+                        group_id,
+                        amount,
+                        currency_id,
+                        code,
+                        date,
+                        type_,
+                        end_to_end_id,
+                        description,
+                        mandate_id,
+                        identification,
+                        signature_date,
+                        scheme,
+                        party_id,
+                        name,
+                    ) = row[:15]
+                    if texts is not None:
+                        end_to_end_id, description = texts[end_to_end_id], texts[description]
+                        debtor = texts[name]
+                    else:
+                        debtor = name
+                    yield SepaPayment(
+                        payment_id,
+                        pain.groups[group_id],
+                        amount,
+                        SepaCurrency(currency_id, code) if currency_id else None,
+                        SepaMandate(
+                            mandate_id,
+                            identification,
+                            signature_date,
+                            scheme,
+                            SepaParty(party_id, name),
+                            _sepa_account_number(row[15:]),
+                        ),
+                        end_to_end_id,
+                        description,
+                        date,
+                        type_,
+                        debtor,
+                    )
+                count += len(rows)
+                if progress:
+                    self.set_generation_progress(count)
+        finally:
+            cursor.close()
+
+    def write_sepa_message(self, sink, pain=None):
+        'Write the message encoded in UTF-8 to the binary file-like sink'
+        if pain is None:
+            pain = self.get_sepa_snapshot()
+        plan = self.get_sepa_batch_plan(pain)
+        writer = sepawriter.WRITERS.get(self.sepa_receivable_flavor)
+        # The streaming writers keep memory bounded on huge messages
+        if writer and config.getboolean('condominium_payment_sepa', 'streaming', default=False):
+            writer(sink, pain, plan, datetime.datetime.now())
+        else:
+            tmpl = self.get_sepa_template()
+            tmpl.generate(pain=pain, plan=plan, datetime=datetime).filter(remove_comment).render(
+                encoding='utf-8', out=sink
+            )
+
+    def get_sepa_limits(self, pain):
+        'Return the maximum number of transactions and of bytes by message of the banks of the snapshot pain'
+        Bank = Pool().get('bank')
+        banks = Bank.browse(list({g.account_number.account.bank.id for g in pain.groups.values()}))
+        nboftxs = [b.max_transactions for b in banks if b.max_transactions]
+        sizes = [b.max_message_size * 1024 for b in banks if b.max_message_size]
+        return min(nboftxs) if nboftxs else None, min(sizes) if sizes else None
+
+    def get_sepa_split(self, pain, max_nboftxs=None, max_size=None, sizer=None):
+        '''Return the parts of the snapshot pain within the limits
+
+        Each part is a list of [key, nboftxs, ctrlsum] of its payment
+        information blocks, a block may be split between parts. sizer is the
+        sepawriter.MessageSizer used to check max_size.
+        '''
+        parts = []
+        part, nboftxs, size = [], 0, sizer.envelope if max_size else 0
+        for key, payments in self.sepa_payments(pain):
+            block = None
+            for payment in payments:
+                extra = 0
+                if max_size:
+                    extra = sizer.transaction(payment) + (sizer.header(key) if block is None else 0)
+                # A transaction over the size limit goes alone in its part
+                if part and (nboftxs == max_nboftxs or (max_size and size + extra > max_size)):
+                    parts.append(part)
+                    part, nboftxs, size, block = [], 0, sizer.envelope if max_size else 0, None
+                    if max_size:
+                        extra = sizer.transaction(payment) + sizer.header(key)
+                if block is None:
+                    block = [key, 0, Decimal(0)]
+                    part.append(block)
+                block[1] += 1
+                block[2] += payment.amount
+                nboftxs += 1
+                size += extra
+        if part:
+            parts.append(part)
+        return parts
+
+    def render_sepa_messages(self):
+        '''Return the messages with their number of transactions and control sum
+
+        There are several messages when the limits of the banks are exceeded
+        and the flavor has a streaming writer.
+        '''
+        pain = self.get_sepa_snapshot()
+        max_nboftxs, max_size = self.get_sepa_limits(pain)
+        if self.sepa_receivable_flavor in sepawriter.WRITERS and (max_nboftxs or max_size):
+            now = datetime.datetime.now()
+            sizer = sepawriter.MessageSizer(self.sepa_receivable_flavor, pain, now) if max_size else None
+            with Transaction().set_context(sepa_generation_progress=False):
+                parts = self.get_sepa_split(pain, max_nboftxs, max_size, sizer)
+            if len(parts) > 1:
+                return self._render_sepa_parts(pain, parts, now)
+        with tempfile.TemporaryFile() as sink:
+            self.write_sepa_message(sink, pain)
+            data, message_id = self._read_sepa_message(sink)
+            return [SepaMessage(data, self.nboftxs, self.ctrlsum, message_id, None)]
+
+    def _render_sepa_parts(self, pain, parts, now):
+        writer = sepawriter.WRITERS[self.sepa_receivable_flavor]
+        # The parts take the payments one after the other from a single stream
+        payments = self.sepa_payment_stream(pain)
+        messages = []
+        for sequence, part in enumerate(parts, 1):
+            # The payments of each part are recorded to apply the statuses reported by the bank
+            payment_ids = []
+            batches = [
+                SepaBatch(key, _record_ids(islice(payments, n), payment_ids), n, ctrlsum) for key, n, ctrlsum in part
+            ]
+            plan = SepaBatchPlan(batches, sum(b.nboftxs for b in batches), sum(b.ctrlsum for b in batches))
+            with tempfile.TemporaryFile() as sink:
+                # The sequence of the part gives each message its own MsgId
+                writer(sink, pain, plan, now, sequence)
+                data, message_id = self._read_sepa_message(sink)
+                messages.append(SepaMessage(data, plan.nboftxs, plan.ctrlsum, message_id, payment_ids))
+        return messages
+
+    def _read_sepa_message(self, sink):
+        'Return the compressed data and the MsgId of the message written to sink once checked'
+        if config.getboolean('condominium_payment_sepa', 'validate', default=False):
+            sink.seek(0)
+            self.check_sepa_message(sink)
+        sink.seek(0)
+        message_id = sepahandler.read_message_id(sink)
+        sink.seek(0)
+        return compress_message_file(sink), message_id
+
+    def check_sepa_message(self, source):
+        'Check the message read from source against the schema of the flavor'
+        schema = get_sepa_schema(self.sepa_receivable_flavor)
+        if schema is None:
+            return
+        try:
+            # The schema is checked while parsing so the tree can be dropped
+            for _, element in etree.iterparse(source, schema=schema):
+                element.clear()
+        except etree.XMLSyntaxError as exception:
+            self.raise_user_error('invalid_message', (self.reference, exception.msg))
+
     @classmethod
-    @ModelView.button
-    @Workflow.transition('draft')
-    def draft(cls, pains):
+    def _set_payments_state(cls, pains, state):
+        'Set the state of the payments of the pains in one statement by slice of pains'
         pool = Pool()
+        Group = pool.get('condo.payment.group')
         Payment = pool.get('condo.payment')
+        group = Group.__table__()
         payment = Payment.__table__()
         cursor = Transaction().connection.cursor()
 
-        pids = [p.id for payments in [group.payments for pain in pains for group in pain.groups] for p in payments]
-        for sub_ids in grouped_slice(pids):
-            red_sql = reduce_ids(payment.id, sub_ids)
-            cursor.execute(*payment.update(columns=[payment.state], values=['draft'], where=red_sql))
+        for sub_ids in grouped_slice([p.id for p in pains]):
+            red_sql = reduce_ids(group.pain, sub_ids)
+            cursor.execute(
+                *payment.update(
+                    columns=[payment.state],
+                    values=[state],
+                    where=payment.group.in_(group.select(group.id, where=red_sql)),
+                )
+            )
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('draft')
+    def draft(cls, pains):
+        cls._set_payments_state(pains, 'draft')
 
     @dualmethod
     @ModelView.button
     @Workflow.transition('generated')
     def generate(cls, pains):
+        messages = (pain.render_sepa_messages() for pain in pains)
+        cls._save_sepa_messages(pains, messages)
+
+    @classmethod
+    def _save_sepa_messages(cls, pains, messages):
+        'Store the next messages of messages on each pain and commit them one by one'
         pool = Pool()
+        Part = pool.get('condo.payment.pain.part')
         Payment = pool.get('condo.payment')
         payment = Payment.__table__()
-        cursor = Transaction().connection.cursor()
-
         for pain in pains:
-            pids = [p.id for group in pain.groups for p in group.payments]
-            for sub_ids in grouped_slice(pids):
-                red_sql = reduce_ids(payment.id, sub_ids)
-
-                cursor.execute(*payment.update(columns=[payment.state], values=['approved'], where=red_sql))
+            cls._set_payments_state([pain], 'approved')
             try:
-                tmpl = pain.get_sepa_template()
-                message = (
-                    tmpl.generate(pain=pain, datetime=datetime, normalize=sepadecode.sepa_conversion)
-                    .filter(remove_comment)
-                    .render()
-                )
-                pain.message = message
-
+                pain_messages = next(messages)
+                cursor = Transaction().connection.cursor()
+                old_parts = Part.search([('pain', '=', pain.id)])
+                for sub_parts in grouped_slice(old_parts):
+                    cursor.execute(
+                        *payment.update(
+                            columns=[payment.pain_part],
+                            values=[None],
+                            where=reduce_ids(payment.pain_part, [p.id for p in sub_parts]),
+                        )
+                    )
+                Part.delete(old_parts)
+                if len(pain_messages) == 1:
+                    pain.message_data = pain_messages[0].data
+                    pain.sepa_message_id = pain_messages[0].message_id
+                else:
+                    pain.message_data = None
+                    pain.sepa_message_id = None
+                    parts = Part.create(
+                        [
+                            {
+                                'pain': pain.id,
+                                'sequence': i,
+                                'message_data': m.data,
+                                'sepa_message_id': m.message_id,
+                                'nboftxs': m.nboftxs,
+                                'ctrlsum': m.ctrlsum,
+                            }
+                            for i, m in enumerate(pain_messages, 1)
+                        ]
+                    )
+                    for part, message in zip(parts, pain_messages):
+                        for sub_ids in grouped_slice(message.payment_ids):
+                            cursor.execute(
+                                *payment.update(
+                                    columns=[payment.pain_part],
+                                    values=[part.id],
+                                    where=reduce_ids(payment.id, sub_ids),
+                                )
+                            )
                 pain.save()
+            except UserError:
+                Transaction().rollback()
+                raise
             except:
                 Transaction().rollback()
                 cls.raise_user_error('generate_error', (pain.reference, pain.company.party.name))
             else:
                 Transaction().commit()
 
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('generating')
+    def queue_generation(cls, pains):
+        cls.write(pains, {'generated_nboftxs': 0, 'generation_error': None})
+        # A task by pain so several workers render them in parallel
+        for pain in pains:
+            cls.__queue__.process_generation([pain])
+
+    @classmethod
+    def process_generation(cls, pains):
+        'Generate the messages of the pains queued for generation, recording the failures'
+        for pain in pains:
+            if pain.state != 'generating':
+                continue
+            try:
+                with Transaction().set_context(sepa_generation_progress=True):
+                    pain_messages = pain.render_sepa_messages()
+                # The progress is committed by other transactions
+                Transaction().commit()
+                # The pain may have been reset to draft while rendering
+                if not pain.lock_generation():
+                    Transaction().rollback()
+                    continue
+                pain.state = 'generated'
+                cls._save_sepa_messages([pain], iter([pain_messages]))
+            except Exception as exception:
+                Transaction().rollback()
+                cls.write(
+                    [cls(pain.id)],
+                    {'state': 'draft', 'generation_error': getattr(exception, 'message', None) or str(exception)},
+                )
+                Transaction().commit()
+
+    def lock_generation(self):
+        'Lock the pain until the end of the transaction and return if it is still generating'
+        table = self.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        query = table.select(table.state, where=table.id == self.id)
+        if transaction.database.has_select_for():
+            query.for_ = For('UPDATE')
+        cursor.execute(*query)
+        row = cursor.fetchone()
+        return bool(row) and row[0] == 'generating'
+
+    def set_generation_progress(self, nboftxs):
+        'Commit at once the number of transactions rendered by the background generation'
+        table = self.__table__()
+        with Transaction().new_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            cursor.execute(
+                *table.update(columns=[table.generated_nboftxs], values=[nboftxs], where=table.id == self.id)
+            )
+            transaction.commit()
+
     @classmethod
     @ModelView.button
     @Workflow.transition('booked')
     def accept(cls, pains):
+        cls._set_payments_state(pains, 'processing')
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('rejected')
+    def cancel(cls, pains):
+        cls._set_payments_state(pains, 'failed')
+
+    def get_sepa_payment_information(self):
+        '''Return the group, date and type of the payments of each payment information block id
+
+        The id is built with the creditor identifier of the company of each
+        group as the groups may be of child condominiums.
+        '''
         pool = Pool()
+        Group = pool.get('condo.payment.group')
         Payment = pool.get('condo.payment')
+        Company = pool.get('company.company')
+        group = Group.__table__()
         payment = Payment.__table__()
+        company = Company.__table__()
         cursor = Transaction().connection.cursor()
 
-        pids = [p.id for payments in [group.payments for pain in pains for group in pain.groups] for p in payments]
-        for sub_ids in grouped_slice(pids):
-            red_sql = reduce_ids(payment.id, sub_ids)
-            cursor.execute(*payment.update(columns=[payment.state], values=['processing'], where=red_sql))
+        cursor.execute(
+            *payment.join(group, condition=payment.group == group.id)
+            .join(company, condition=group.company == company.id)
+            .select(
+                group.id,
+                company.sepa_creditor_identifier,
+                payment.date,
+                payment.type,
+                where=group.pain == self.id,
+                group_by=[group.id, company.sepa_creditor_identifier, payment.date, payment.type],
+            )
+        )
+        result = {}
+        for group_id, identifier, date, type_ in cursor.fetchall():
+            id_ = sepawriter.payment_information_id(date, Payment(type=type_).sequence_type, identifier)
+            result.setdefault(id_, []).append((group_id, date, type_))
+        return result
+
+    def get_sepa_end_to_end_ids(self):
+        '''Return the stored end to end ids of the payments by the end to end id sent
+
+        The ids sent are truncated and, with subset, converted like in the
+        messages.
+        '''
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        Payment = pool.get('condo.payment')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
 
-    @classmethod
-    @ModelView.button
-    @Workflow.transition('rejected')
-    def cancel(cls, pains):
+        cursor.execute(
+            *payment.join(group, condition=payment.group == group.id).select(
+                payment.sepa_end_to_end_id, where=group.pain == self.id, group_by=[payment.sepa_end_to_end_id]
+            )
+        )
+        stored_ids = [r[0] for r in cursor.fetchall() if r[0]]
+        if self.subset:
+            country = self.country_subset.code if self.country_subset else None
+            sent_ids = sepadecode.sepa_conversions(country, stored_ids)
+        else:
+            sent_ids = {i: i for i in stored_ids}
+        result = {}
+        for stored_id in stored_ids:
+            result.setdefault(sent_ids[stored_id][:35], []).append(stored_id)
+        return result
+
+    def get_sepa_messages(self):
+        '''Return the split message of each MsgId sent, None for the message of the pain
+
+        The parts generated before the payments were linked to them are
+        returned as None too.
+        '''
+        Payment = Pool().get('condo.payment')
+        result = {}
+        if self.sepa_message_id:
+            result[self.sepa_message_id] = None
+        parts = [p for p in self.parts if p.sepa_message_id]
+        linked = parts and Payment.search([('pain_part', 'in', [p.id for p in parts])], limit=1)
+        for part in parts:
+            result[part.sepa_message_id] = part.id if linked else None
+        return result
+
+    def _get_sepa_report_part(self, messages, message_id):
+        'Return the split message of the original MsgId of a status report'
+        if message_id not in messages:
+            self.raise_user_error('unknown_status_report', (message_id, self.reference))
+        return messages[message_id]
+
+    def _update_payments_state(self, state, from_states, where=None, part=None):
+        'Set state to the payments of the pain, or only of its split message part, in from_states matching where'
         pool = Pool()
+        Group = pool.get('condo.payment.group')
         Payment = pool.get('condo.payment')
+        group = Group.__table__()
         payment = Payment.__table__()
         cursor = Transaction().connection.cursor()
 
-        pids = [p.id for payments in [group.payments for pain in pains for group in pain.groups] for p in payments]
-        for sub_ids in grouped_slice(pids):
-            red_sql = reduce_ids(payment.id, sub_ids)
-            cursor.execute(*payment.update(columns=[payment.state], values=['failed'], where=red_sql))
+        condition = payment.group.in_(group.select(group.id, where=group.pain == self.id)) & payment.state.in_(
+            list(from_states)
+        )
+        if where is not None:
+            condition &= where(payment)
+        if part is not None:
+            condition &= payment.pain_part == part
+        cursor.execute(*payment.update(columns=[payment.state], values=[state], where=condition))
+
+    def _set_sepa_transaction_statuses(self, payment_information, end_to_end_ids, messages, message_id, statuses):
+        'Apply the transaction statuses of a chunk of a status report'
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        Payment = pool.get('condo.payment')
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        mandate = Mandate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        part = self._get_sepa_report_part(messages, message_id)
+        where = group.pain == self.id
+        if part is not None:
+            where &= payment.pain_part == part
+        sent_ids = {}
+        for end_to_end_id in set(s.end_to_end_id for s in statuses):
+            for stored_id in end_to_end_ids.get(end_to_end_id, []):
+                sent_ids[stored_id] = end_to_end_id
+        candidates = {}
+        for sub_ids in grouped_slice(list(sent_ids)):
+            cursor.execute(
+                *payment.join(group, condition=payment.group == group.id)
+                .join(mandate, condition=payment.mandate == mandate.id)
+                .select(
+                    payment.id,
+                    payment.sepa_end_to_end_id,
+                    mandate.identification,
+                    payment.group,
+                    payment.date,
+                    payment.type,
+                    where=where & payment.sepa_end_to_end_id.in_(list(sub_ids)),
+                )
+            )
+            for id_, end_to_end_id, identification, group_id, date, type_ in cursor.fetchall():
+                candidates.setdefault(sent_ids[end_to_end_id], []).append(
+                    (id_, identification, (group_id, date, type_))
+                )
+
+        failed, succeeded = [], []
+        for status in statuses:
+            if status.status == sepahandler.REJECTED:
+                ids = failed
+            elif status.status in sepahandler.ACCEPTED:
+                ids = succeeded
+            else:
+                continue
+            keys = payment_information.get(status.payment_information_id)
+            for id_, identification, key in candidates.get(status.end_to_end_id, []):
+                if status.mandate_identification and status.mandate_identification != identification:
+                    continue
+                if keys is not None and key not in keys:
+                    continue
+                ids.append(id_)
+
+        for ids, state, from_states in (
+            (failed, 'failed', ['processing', 'succeeded']),
+            (succeeded, 'succeeded', ['processing']),
+        ):
+            for sub_ids in grouped_slice(ids):
+                self._update_payments_state(state, from_states, lambda payment: reduce_ids(payment.id, sub_ids))
+
+    def _set_sepa_batch_status(self, status, keys=None, part=None):
+        'Apply the status of the whole message or of the payment information blocks of keys'
+        if keys is not None:
+
+            def where(payment):
+                condition = Literal(False)
+                for group_id, date, type_ in keys:
+                    condition |= (payment.group == group_id) & (payment.date == date) & (payment.type == type_)
+                return condition
+
+        else:
+            where = None
+        if status == sepahandler.REJECTED:
+            self._update_payments_state('failed', ['processing'], where, part)
+        elif status == sepahandler.PARTIALLY_ACCEPTED or status in sepahandler.ACCEPTED:
+            # The transactions not reported as rejected are accepted
+            self._update_payments_state('succeeded', ['processing'], where, part)
+
+    def import_sepa_status_report(self, source):
+        '''Update the payments with the pain.002 status report read from source
+
+        The report is read in chunks of transactions whose payments are
+        updated at once. Only the payments of the message, or split message,
+        it reports on are updated.
+        '''
+        if self.state != 'booked':
+            self.raise_user_error('import_not_booked', (self.reference,))
+        payment_information = self.get_sepa_payment_information()
+        end_to_end_ids = self.get_sepa_end_to_end_ids()
+        messages = self.get_sepa_messages()
+        try:
+            report = sepahandler.PAIN002(
+                source,
+                partial(self._set_sepa_transaction_statuses, payment_information, end_to_end_ids, messages),
+                Transaction().database.IN_MAX,
+            )
+        except etree.XMLSyntaxError as exception:
+            self.raise_user_error('invalid_status_report', (exception.msg,))
+        part = self._get_sepa_report_part(messages, report.message_id)
+        for id_, status in report.payment_information.items():
+            if id_ in payment_information:
+                self._set_sepa_batch_status(status, payment_information[id_], part)
+        if report.group_status:
+            self._set_sepa_batch_status(report.group_status, part=part)
+
+
+def _clear_cache(model, ids=None):
+    'Drop the values of model cached by the transaction after a raw update of ids or all the records'
+    transaction = Transaction()
+    # Refresh the local caches of the instances
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if model.__name__ not in cache:
+            continue
+        if ids is None:
+            cache[model.__name__].clear()
+            continue
+        for id_ in ids:
+            if id_ in cache[model.__name__]:
+                cache[model.__name__][id_].clear()
+
+
+def _record_ids(records, ids):
+    'Yield records adding their id to ids'
+    for record in records:
+        ids.append(record.id)
+        yield record
 
 
 def remove_comment(stream):
@@ -326,7 +1214,54 @@ def remove_comment(stream):
         yield kind, data, pos
 
 
-loader = genshi.template.TemplateLoader(os.path.join(os.path.dirname(__file__), 'template'), auto_reload=True)
+def load_sepa_templates():
+    '''Parse the templates of every receivable flavor into a new loader
+
+    Templates are checked for changes on each use only when the
+    template_auto_reload option is set, calling this again reloads them.
+    '''
+    global loader
+    loader = genshi.template.TemplateLoader(
+        os.path.join(os.path.dirname(__file__), 'template'),
+        auto_reload=config.getboolean('condominium_payment_sepa', 'template_auto_reload', default=False),
+    )
+    for flavor, _ in CondoPain.sepa_receivable_flavor.selection:
+        if flavor:
+            loader.load('%s.xml' % flavor)
+
+
+load_sepa_templates()
+
+_schemas = {}
+
+
+def get_sepa_schema(flavor):
+    'Return the compiled XML schema of flavor, parsed once by process'
+    if flavor not in _schemas:
+        path = os.path.join(os.path.dirname(__file__), 'xsd', '%s.xsd' % flavor)
+        _schemas[flavor] = etree.XMLSchema(etree.parse(path)) if os.path.exists(path) else None
+    return _schemas[flavor]
+
+
+if config.getboolean('condominium_payment_sepa', 'validate', default=False):
+    # Parsed once at import time
+    for flavor, _ in CondoPain.sepa_receivable_flavor.selection:
+        get_sepa_schema(flavor)
+
+
+class CondoPainPart(MessageMixin, ModelSQL, ModelView):
+    'Condominium Payment Initiation Message Part'
+    __name__ = 'condo.payment.pain.part'
+    pain = fields.Many2One('condo.payment.pain', 'Message', ondelete='CASCADE', required=True, select=True)
+    sequence = fields.Integer('Sequence', readonly=True, required=True)
+    message = fields.Function(fields.Text('Message', readonly=True), 'get_message', setter='set_message')
+    nboftxs = fields.Integer('Number of Transactions', readonly=True)
+    ctrlsum = fields.Numeric('Control Sum', digits=(11, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CondoPainPart, cls).__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
 
 
 class Group(ModelSQL, ModelView):
@@ -372,8 +1307,8 @@ class Group(ModelSQL, ModelView):
         sort=False,
         states={'readonly': Bool(Eval('readonly'))},
     )
-    nboftxs = fields.Function(fields.Integer('Number of Transactions'), 'get_nboftxs')
-    ctrlsum = fields.Function(fields.Numeric('Control Sum', digits=(11, 2)), 'get_ctrlsum')
+    nboftxs = fields.Integer('Number of Transactions', readonly=True, select=True)
+    ctrlsum = fields.Numeric('Control Sum', digits=(11, 2), readonly=True, select=True)
     readonly = fields.Function(fields.Boolean('State'), getter='get_readonly', searcher='search_readonly')
 
     @classmethod
@@ -388,66 +1323,101 @@ class Group(ModelSQL, ModelView):
             )
         ]
         cls._error_messages.update(
-            {'payments_approved': ('PaymentGroup "%s" has payments approved' ' with earlier date.')}
+            {
+                'payments_approved': ('PaymentGroup "%s" has payments approved' ' with earlier date.'),
+                'missing_account_number': ('Condominium "%s" has no IBAN account number to collect payments.'),
+                'invalid_fee_run_mandate': ('Mandate "%s" needs a type and an account number to collect fees.'),
+                'missing_fee_run_amount': ('Unit "%s" has no previous payment with mandate "%s" and no amount is set.'),
+            }
         )
+        cls.__rpc__.update({'update_totals': RPC(readonly=False, instantiate=0)})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        add_totals = TableHandler.table_exist(cls._table) and not cls.__table_handler__(module_name).column_exist(
+            'nboftxs'
+        )
+
+        super(Group, cls).__register__(module_name)
+
+        # Migration from the computed totals
+        if add_totals:
+            cls.update_totals()
 
     @staticmethod
     def default_sepa_batch_booking():
         Configuration = Pool().get('condo.payment.group.configuration')
-        config = Configuration(1)
-        if config.sepa_batch_booking_selection == '1':
+        selection = Configuration.get_defaults()['sepa_batch_booking_selection']
+        if selection == '1':
             return True
-        elif config.sepa_batch_booking_selection == '0':
+        elif selection == '0':
             return False
 
     @staticmethod
     def default_sepa_charge_bearer():
         Configuration = Pool().get('condo.payment.group.configuration')
-        config = Configuration(1)
-        if config.sepa_charge_bearer:
-            return config.sepa_charge_bearer
+        return Configuration.get_defaults()['sepa_charge_bearer']
 
     @classmethod
     def validate(cls, groups):
         super(Group, cls).validate(groups)
+        pool = Pool()
+        Payment = pool.get('condo.payment')
+        table = cls.__table__()
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
 
-        payments = Pool().get('condo.payment').__table__()
-
+        groups = [g for g in groups if not g.readonly]
         for group in groups:
-            if group.readonly:
-                continue
-
             group.check_today()
             group.check_businessdate()
             group.company_has_sepa_creditor_identifier()
 
-            with Transaction().connection.cursor() as cursor:
-                # there are approved payments with due date before new date
-                # so raise user error
+        for sub_ids in grouped_slice([g.id for g in groups]):
+            sub_ids = list(sub_ids)
+            red_sql = reduce_ids(table.id, sub_ids)
+            # there are approved payments with due date before new date
+            # so raise user error
+            cursor.execute(
+                *payment.join(table, condition=payment.group == table.id).select(
+                    table.id,
+                    where=red_sql & (payment.date < table.date) & (payment.state != 'draft'),
+                    group_by=table.id,
+                    limit=1,
+                )
+            )
+            row = cursor.fetchone()
+            if row:
+                cls.raise_user_error('payments_approved', (cls(row[0]).reference))
+
+            # there are drafted payments with due date before new date
+            # update date field of payments
+            # Use SQL to prevent double validate loop
+            if backend.name() != 'sqlite' or sqlite3.sqlite_version_info >= (3, 33, 0):
                 cursor.execute(
-                    *payments.select(
-                        payments.id,
-                        where=(payments.group == group.id) & (payments.date < group.date) & (payments.state != 'draft'),
+                    *payment.update(
+                        columns=[payment.date],
+                        values=[table.date],
+                        from_=[table],
+                        where=red_sql
+                        & (payment.group == table.id)
+                        & (payment.date < table.date)
+                        & (payment.state == 'draft'),
                     )
                 )
-                if cursor.fetchall():
-                    cls.raise_user_error('payments_approved', (group.reference))
-
-                # there are drafted payments with due date before new date
-                # update date field of payments
+            else:
+                # UPDATE ... FROM comes with SQLite 3.33
+                group_date = table.select(table.date, where=table.id == payment.group)
                 cursor.execute(
-                    *payments.select(
-                        payments.id,
-                        where=(payments.group == group.id) & (payments.date < group.date) & (payments.state == 'draft'),
+                    *payment.update(
+                        columns=[payment.date],
+                        values=[group_date],
+                        where=reduce_ids(payment.group, sub_ids)
+                        & (payment.date < group_date)
+                        & (payment.state == 'draft'),
                     )
                 )
-                ids_draft = [ids for (ids,) in cursor.fetchall()]
-
-                if len(ids_draft):
-                    for sub_ids in grouped_slice(ids_draft):
-                        red_sql = reduce_ids(payments.id, sub_ids)
-                        # Use SQL to prevent double validate loop
-                        cursor.execute(*payments.update(columns=[payments.date], values=[group.date], where=red_sql))
 
     def check_today(self):
         if self.date:
@@ -465,15 +1435,203 @@ class Group(ModelSQL, ModelView):
         if not self.company.sepa_creditor_identifier:
             self.raise_user_error("Company must have a sepa creditor identifier")
 
-    def get_nboftxs(self, name):
-        if self.payments:
-            # return len(self.payments)
-            # we get only payments with valid amount
-            return sum(1 for p in self.payments if p.amount)
+    @classmethod
+    def create(cls, vlist):
+        groups = super(Group, cls).create(vlist)
+        cls.update_totals(groups)
+        return groups
+
+    @classmethod
+    def write(cls, *args):
+        Pain = Pool().get('condo.payment.pain')
+        actions = iter(args)
+        pains = set()
+        for groups, values in zip(actions, actions):
+            if 'pain' in values:
+                pains.update(g.pain for g in groups if g.pain)
+                if values['pain']:
+                    pains.add(Pain(values['pain']))
+        super(Group, cls).write(*args)
+        if pains:
+            Pain.update_totals(list(pains))
+
+    @classmethod
+    def delete(cls, groups):
+        Pain = Pool().get('condo.payment.pain')
+        pains = list(set(g.pain for g in groups if g.pain))
+        super(Group, cls).delete(groups)
+        if pains:
+            Pain.update_totals(pains)
+
+    @classmethod
+    def get_fee_run_mandates(cls, companies, amount_rule):
+        """Return the unit, party and active mandate of each condominium party of companies
 
-    def get_ctrlsum(self, name):
-        if self.payments:
-            return sum(p.amount for p in self.payments if p.amount)
+        With the last amount of the unit and mandate for the 'last' rule,
+        in one query.
+        """
+        pool = Pool()
+        CondoParty = pool.get('condo.party')
+        Unit = pool.get('condo.unit')
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        Payment = pool.get('condo.payment')
+        condoparty = CondoParty.__table__()
+        unit = Unit.__table__()
+        mandate = Mandate.__table__()
+        last = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [
+            unit.company,
+            unit.id,
+            unit.name,
+            condoparty.party,
+            mandate.id,
+            mandate.type,
+            mandate.identification,
+            mandate.account_number,
+        ]
+        if amount_rule == 'last':
+            columns.append(
+                last.select(
+                    Payment.amount.sql_column(last),
+                    where=(last.unit == unit.id) & (last.mandate == mandate.id),
+                    order_by=[last.date.desc, last.id.desc],
+                    limit=1,
+                )
+            )
+        where = ~mandate.state.in_(['draft', 'canceled']) & (condoparty.active == Literal(True))
+
+        result = []
+        for sub_ids in grouped_slice([c.id for c in companies]):
+            cursor.execute(
+                *condoparty.join(unit, condition=condoparty.unit == unit.id)
+                .join(mandate, condition=condoparty.mandate == mandate.id)
+                .select(*columns, where=where & reduce_ids(unit.company, sub_ids), order_by=[unit.company, unit.name])
+            )
+            result.extend(cursor.fetchall())
+        return result
+
+    @classmethod
+    def get_fee_run_account_numbers(cls, companies):
+        'Return the first active IBAN account number of the party of each company'
+        pool = Pool()
+        Company = pool.get('company.company')
+        Account = pool.get('bank.account')
+        AccountParty = pool.get('bank.account-party.party')
+        Number = pool.get('bank.account.number')
+        company = Company.__table__()
+        account = Account.__table__()
+        account_party = AccountParty.__table__()
+        number = Number.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice([c.id for c in companies]):
+            cursor.execute(
+                *company.join(account_party, condition=account_party.owner == company.party)
+                .join(account, condition=account_party.account == account.id)
+                .join(number, condition=number.account == account.id)
+                .select(
+                    company.id,
+                    Min(number.id),
+                    where=reduce_ids(company.id, sub_ids) & (number.type == 'iban') & (account.active == Literal(True)),
+                    group_by=company.id,
+                )
+            )
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def create_fee_run(cls, companies, values, amount_rule, amount=None, description=None):
+        """Create a group with values for each of companies with a payment for each active mandate
+
+        amount_rule is 'fixed' to debit amount or 'last' to debit again the
+        last amount of the unit and mandate, or amount when the unit has no
+        previous payment with the mandate. The payments are created by
+        slices.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Payment = pool.get('condo.payment')
+
+        rows = cls.get_fee_run_mandates(companies, amount_rule)
+        for row in rows:
+            if not row[5] or not row[7]:
+                cls.raise_user_error('invalid_fee_run_mandate', (row[6],))
+            if amount_rule == 'last' and row[8] is None and amount is None:
+                cls.raise_user_error('missing_fee_run_amount', (row[2], row[6]))
+        company_ids = list(OrderedDict.fromkeys(r[0] for r in rows))
+        account_numbers = cls.get_fee_run_account_numbers(Company.browse(company_ids))
+        for company in Company.browse(company_ids):
+            if company.id not in account_numbers:
+                cls.raise_user_error('missing_account_number', (company.party.name,))
+
+        groups = cls.create(
+            [dict(values, company=company_id, account_number=account_numbers[company_id]) for company_id in company_ids]
+        )
+        groups_by_company = {g.company.id: g for g in groups}
+
+        vlist = []
+        for row in rows:
+            company_id, unit_id, unit_name, party_id, mandate_id, type_ = row[:6]
+            row_amount = row[8] if amount_rule == 'last' and row[8] is not None else amount
+            if not isinstance(row_amount, Decimal):
+                # SQLite returns numeric as float
+                row_amount = Decimal(str(row_amount)).quantize(Decimal('0.01'))
+            group = groups_by_company[company_id]
+            vlist.append(
+                {
+                    'group': group.id,
+                    'unit': unit_id,
+                    'party': party_id,
+                    'mandate': mandate_id,
+                    'currency': group.company.currency.id,
+                    'amount': row_amount,
+                    'type': type_,
+                    'sepa_end_to_end_id': unit_name[:35] if unit_name else None,
+                    'description': description,
+                    'date': group.date,
+                }
+            )
+        # Each slice is checked and validated at once
+        for sub_vlist in grouped_slice(vlist):
+            Payment.create(list(sub_vlist))
+        return groups
+
+    @classmethod
+    def update_totals(cls, groups=None):
+        'Update the stored totals of the groups and of their pains'
+        pool = Pool()
+        Pain = pool.get('condo.payment.pain')
+        Payment = pool.get('condo.payment')
+        table = cls.__table__()
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+        amount = Payment.amount.sql_column(payment)
+
+        # groups without payments have no totals
+        # and only payments with valid amount are counted
+        nboftxs = payment.select(Sum(Case((amount != 0, 1), else_=0)), where=payment.group == table.id)
+        ctrlsum = payment.select(Sum(Coalesce(amount, 0)), where=payment.group == table.id)
+        if groups is None:
+            cursor.execute(*table.update(columns=[table.nboftxs, table.ctrlsum], values=[nboftxs, ctrlsum]))
+            _clear_cache(cls)
+            Pain.update_totals()
+            return
+
+        group_ids = list(set(g.id for g in groups))
+        pain_ids = set()
+        for sub_ids in grouped_slice(group_ids):
+            red_sql = reduce_ids(table.id, sub_ids)
+            cursor.execute(
+                *table.update(columns=[table.nboftxs, table.ctrlsum], values=[nboftxs, ctrlsum], where=red_sql)
+            )
+            cursor.execute(*table.select(table.pain, where=red_sql & (table.pain != None), group_by=table.pain))
+            pain_ids.update(pain_id for pain_id, in cursor.fetchall())
+        _clear_cache(cls, group_ids)
+        if pain_ids:
+            Pain.update_totals(Pain.browse(pain_ids))
 
     def get_readonly(self, name):
         return self.pain.state != 'draft' if self.pain else False
@@ -538,7 +1696,6 @@ class Payment(Workflow, ModelSQL, ModelView):
         ],
         ondelete='RESTRICT',
         required=True,
-        select=True,
         states={'readonly': Eval('id', 0) > 0},
     )
     company = fields.Function(
@@ -568,7 +1725,7 @@ class Payment(Workflow, ModelSQL, ModelView):
         ],
         states={'readonly': Eval('state') != 'draft'},
     )
-    unit_name = fields.Function(fields.Char('Unit'), getter='get_unit_name', searcher='search_unit_name')
+    unit_name = fields.Function(fields.Char('Unit'), getter='get_unit_name')
     party = fields.Many2One(
         'party.party',
         'Ultimate Debtor',
@@ -634,7 +1791,7 @@ class Payment(Workflow, ModelSQL, ModelView):
         required=True,
         states={'readonly': Eval('state') != 'draft'},
     )
-    debtor = fields.Function(fields.Char('Debtor'), getter='get_debtor', searcher='search_debtor')
+    debtor = fields.Function(fields.Char('Debtor'), getter='get_debtor')
     type = fields.Selection(
         [('recurrent', 'RCUR'), ('one-off', 'OOFF'), ('final', 'FNAL'), ('first', 'FRST')],
         'Sequence Type',
@@ -648,6 +1805,14 @@ class Payment(Workflow, ModelSQL, ModelView):
         size=35,
         states={'readonly': Eval('state') != 'draft'},
     )
+    pain_part = fields.Many2One(
+        'condo.payment.pain.part',
+        'Split Message',
+        ondelete='SET NULL',
+        readonly=True,
+        select=True,
+        help='Message sent with the payment when the message was split',
+    )
     date = fields.Date(
         'Debit Date', required=True, states={'readonly': Eval('state') != 'draft'}, depends=['group', 'state']
     )
@@ -668,14 +1833,22 @@ class Payment(Workflow, ModelSQL, ModelView):
         super(Payment, cls).__setup__()
         cls._order.insert(0, ('date', 'DESC'))
         cls._order.insert(1, ('unit.name', 'ASC'))
+        cls.__rpc__.update({'search_keyset': RPC(result=lambda r: list(map(int, r)))})
         cls._error_messages.update(
             {
                 'delete_draft': ('Payment "%s" must be in draft before ' 'deletion.'),
-                'invalid_mandate': ('Payment of "%s" has an invalid' ' mandate "%s"'),
+                'invalid_mandate': ('Mandate "%s" has no account number.'),
+                'invalid_duedate': ('Fee due date must be equal or bigger than his group date'),
+                'invalid_businessdate': ('Date must be a business day!'),
+                'invalid_consecutive_slashes': ("Data elements can't contain 2 consecutive '/'"),
+                'invalid_slash': ("Data elements can't start or end with '/' character"),
+                'invalid_payment': ('Payment of "%s" on %s: %s'),
+                'invalid_payments': ('Some payments are not valid.'),
                 'invalid_draft': ('Message "%s" must be in draft to put' ' payment of "%s" to "%s" in draft too.'),
                 'invalid_succeeded': (
                     'Message "%s" must be booked to put' ' payment of "%s" to "%s" in succeeded state.'
                 ),
+                'invalid_statement': ('Bank statement "%s" is not valid: %s'),
             }
         )
         cls._transitions |= set(
@@ -702,35 +1875,71 @@ class Payment(Workflow, ModelSQL, ModelView):
     @classmethod
     def validate(cls, payments):
         super(Payment, cls).validate(payments)
+        cls.check_draft_payments(payments)
 
-        for payment in payments:
-            if payment.state == 'draft':
-                payment.check_duedate()
-                payment.check_businessdate()
-                payment.check_account_number()
-                payment.check_xml_characters()
-
-    def check_duedate(self):
-        if self.group and self.group.date:
-            if self.date < self.group.date:
-                self.raise_user_error("Fee due date must be equal or bigger than his group date")
+    @classmethod
+    def check_draft_payments(cls, payments):
+        """Check the draft payments with their group, mandate and party read at once
 
-    def check_businessdate(self):
-        if self.date and self.date.weekday() in (5, 6):
-            self.raise_user_error("Date must be a business day!")
+        All the errors found are raised together.
+        """
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        Party = pool.get('party.party')
+        payment = cls.__table__()
+        group = Group.__table__()
+        mandate = Mandate.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
 
-    def check_account_number(self):
-        if not self.mandate.account_number:
-            self.raise_user_error('invalid_mandate', (self.party.name, self.mandate.identification))
+        errors = []
+        for sub_ids in grouped_slice([p.id for p in payments]):
+            cursor.execute(
+                *payment.join(group, condition=payment.group == group.id)
+                .join(mandate, condition=payment.mandate == mandate.id)
+                .join(party, condition=payment.party == party.id)
+                .select(
+                    party.name,
+                    payment.date,
+                    group.date,
+                    mandate.identification,
+                    mandate.account_number,
+                    payment.description,
+                    payment.sepa_end_to_end_id,
+                    where=reduce_ids(payment.id, sub_ids) & (payment.state == 'draft'),
+                    order_by=[payment.id],
+                )
+            )
+            for row in cursor.fetchall():
+                name, date = row[:2]
+                for error, error_args in cls._get_draft_payment_errors(*row[1:]):
+                    errors.append(
+                        cls.raise_user_error(
+                            'invalid_payment',
+                            (name, date, cls.raise_user_error(error, error_args, raise_exception=False)),
+                            raise_exception=False,
+                        )
+                    )
+        if errors:
+            cls.raise_user_error('invalid_payments', error_description='\n'.join(errors))
 
-    def check_xml_characters(self):
-        for f in [self.description, self.sepa_end_to_end_id]:
-            if not f:
-                return
-            elif '//' in f:
-                self.raise_user_error("Data elements can't contain 2 consecutive '/'")
-            elif f.startswith('/') or f.endswith('/'):
-                self.raise_user_error("Data elements can't start or end with '/' character")
+    @staticmethod
+    def _get_draft_payment_errors(date, group_date, identification, account_number, description, end_to_end_id):
+        'Yield the error key and arguments of each check failed by the values of a draft payment'
+        if group_date and date < group_date:
+            yield 'invalid_duedate', None
+        if date and date.weekday() in (5, 6):
+            yield 'invalid_businessdate', None
+        if not account_number:
+            yield 'invalid_mandate', (identification,)
+        for value in [description, end_to_end_id]:
+            if not value:
+                continue
+            elif '//' in value:
+                yield 'invalid_consecutive_slashes', None
+            elif value.startswith('/') or value.endswith('/'):
+                yield 'invalid_slash', None
 
     @staticmethod
     def default_state():
@@ -775,22 +1984,31 @@ class Payment(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def get_unit_name(cls, payments, name):
-        return dict([(p.id, p.unit.name if p.unit else None) for p in payments])
+        pool = Pool()
+        Unit = pool.get('condo.unit')
+        payment = cls.__table__()
+        unit = Unit.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([p.id for p in payments])
+        for sub_ids in grouped_slice(payments):
+            cursor.execute(
+                *payment.join(unit, condition=payment.unit == unit.id).select(
+                    payment.id, unit.name, where=reduce_ids(payment.id, sub_ids)
+                )
+            )
+            result.update(cursor.fetchall())
+        return result
 
     @classmethod
-    def search_unit_name(cls, name, domain):
+    def domain_unit_name(cls, domain, tables):
+        table, _ = tables[None]
         _, operator, value = domain
         Operator = fields.SQL_OPERATORS[operator]
 
-        pool = Pool()
-        table1 = pool.get('condo.unit').__table__()
-        table2 = cls.__table__()
-
-        query = table1.join(table2, condition=table1.id == table2.unit).select(
-            table2.id, where=Operator(table1.name, value)
-        )
+        unit = Pool().get('condo.unit').__table__()
 
-        return [('id', 'in', query)]
+        return Exists(unit.select(unit.id, where=(unit.id == table.unit) & Operator(unit.name, value)))
 
     @classmethod
     def order_unit_name(cls, tables):
@@ -832,33 +2050,77 @@ class Payment(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def get_debtor(cls, payments, name):
-        return dict([(p.id, p.mandate.party.name if p.mandate else None) for p in payments])
+        pool = Pool()
+        Mandate = pool.get('condo.payment.sepa.mandate')
+        Party = pool.get('party.party')
+        payment = cls.__table__()
+        mandate = Mandate.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([p.id for p in payments])
+        for sub_ids in grouped_slice(payments):
+            cursor.execute(
+                *payment.join(mandate, condition=payment.mandate == mandate.id)
+                .join(party, condition=mandate.party == party.id)
+                .select(payment.id, party.name, where=reduce_ids(payment.id, sub_ids))
+            )
+            result.update(cursor.fetchall())
+        return result
 
     @classmethod
-    def search_debtor(cls, name, domain):
+    def domain_debtor(cls, domain, tables):
+        table, _ = tables[None]
         _, operator, value = domain
         Operator = fields.SQL_OPERATORS[operator]
 
         pool = Pool()
-        table1 = pool.get('party.party').__table__()
-        table2 = pool.get('condo.payment.sepa.mandate').__table__()
-        table3 = cls.__table__()
+        party = pool.get('party.party').__table__()
+        mandate = pool.get('condo.payment.sepa.mandate').__table__()
 
-        # SELECT "c"."id" FROM "party_party" AS "a" INNER JOIN "condo_payment_sepa_mandate" AS "b"
-        #              ON ("a"."id" = "b"."party") INNER JOIN "condo_payment" AS "c"
-        #              ON ("b"."id" = "c"."mandate") WHERE (UPPER("a"."name") LIKE UPPER(?))
-        query = (
-            table1.join(table2, condition=table1.id == table2.party)
-            .join(table3, condition=table2.id == table3.mandate)
-            .select(table3.id, where=Operator(table1.name, value))
+        return Exists(
+            mandate.join(party, condition=party.id == mandate.party).select(
+                mandate.id, where=(mandate.id == table.mandate) & Operator(party.name, value)
+            )
         )
 
-        return [('id', 'in', query)]
-
     @classmethod
     def order_debtor(cls, tables):
         return cls.mandate.convert_order('mandate.party.name', tables, cls)
 
+    @classmethod
+    def search_keyset(cls, domain, after=None, limit=1000):
+        """Return the page of payments of domain that follows after
+
+        Payments are ordered by date descending, unit name and id. after is
+        the (date, unit name, id) of the last payment of the previous page,
+        None for the first page. Unlike offset, the cost of a page does not
+        depend on the number of pages read before.
+
+        Payments without unit sort as an empty unit name, first of their
+        date, on every backend. The default order leaves their place to the
+        backend, PostgreSQL sorts them last of their date.
+        """
+        Unit = Pool().get('condo.unit')
+        payment = cls.__table__()
+        unit = Unit.__table__()
+        cursor = Transaction().connection.cursor()
+
+        unit_name = Coalesce(unit.name, '')
+        where = payment.id.in_(cls.search(domain, order=[], query=True))
+        if after:
+            date, name, id_ = after
+            name = name or ''
+            where &= (payment.date < date) | (
+                (payment.date == date) & ((unit_name > name) | ((unit_name == name) & (payment.id > id_)))
+            )
+        cursor.execute(
+            *payment.join(unit, 'LEFT', condition=payment.unit == unit.id).select(
+                payment.id, where=where, order_by=[payment.date.desc, unit_name.asc, payment.id.asc], limit=limit
+            )
+        )
+        return cls.browse([r[0] for r in cursor.fetchall()])
+
     @property
     def sequence_type(self):
         if self.type == 'one-off':
@@ -870,12 +2132,49 @@ class Payment(Workflow, ModelSQL, ModelView):
         else:
             return 'RCUR'
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(Payment, cls).__register__(module_name)
+
+        table = cls.__table_handler__(module_name)
+        # Composite indexes of the frequent filters, the one on group
+        # replaces the index of the column
+        table.index_action(['group', 'date', 'state'], 'add')
+        table.index_action(['mandate', 'state'], 'add')
+        table.index_action(['date', 'unit'], 'add')
+        # Match the transactions of the status reports and statements
+        table.index_action(['sepa_end_to_end_id', 'mandate'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        Group = Pool().get('condo.payment.group')
+        payments = super(Payment, cls).create(vlist)
+        Group.update_totals(list(set(p.group for p in payments)))
+        return payments
+
+    @classmethod
+    def write(cls, *args):
+        Group = Pool().get('condo.payment.group')
+        actions = iter(args)
+        groups = set()
+        for payments, values in zip(actions, actions):
+            if 'group' in values or 'amount' in values:
+                groups.update(p.group for p in payments)
+                if values.get('group'):
+                    groups.add(Group(values['group']))
+        super(Payment, cls).write(*args)
+        if groups:
+            Group.update_totals(list(groups))
+
     @classmethod
     def delete(cls, payments):
+        Group = Pool().get('condo.payment.group')
         for payment in payments:
             if payment.state != 'draft':
                 cls.raise_user_error('delete_draft', (payment.rec_name))
+        groups = list(set(p.group for p in payments))
         super(Payment, cls).delete(payments)
+        Group.update_totals(groups)
 
     @classmethod
     @ModelView.button
@@ -916,6 +2215,185 @@ class Payment(Workflow, ModelSQL, ModelView):
     def fail(cls, payments):
         pass
 
+    @classmethod
+    def reconcile_sepa_statements(cls, sources):
+        '''Succeed or fail the payments of the transactions of the statements
+
+        sources is a list of (name, file) of camt.053 or camt.054 messages.
+        Return the statement lines that match no payment.
+        '''
+        index, loaded, unmatched = {}, set(), []
+        handle_lines = partial(cls._reconcile_sepa_lines, index, loaded, unmatched)
+        size = Transaction().database.IN_MAX
+        for name, source in sources:
+            try:
+                sepahandler.CAMT(source, handle_lines, size)
+            except etree.XMLSyntaxError as exception:
+                cls.raise_user_error('invalid_statement', (name, exception.msg))
+        return unmatched
+
+    @classmethod
+    def _load_sepa_reconciliation_index(cls, index, account, dates):
+        '''Add to index the payments to reconcile collected on account at dates
+
+        They are keyed by the end to end id sent, amount, date and account
+        and hold a list of [id, state].
+        '''
+        pool = Pool()
+        Group = pool.get('condo.payment.group')
+        Pain = pool.get('condo.payment.pain')
+        Number = pool.get('bank.account.number')
+        Country = pool.get('country.country')
+        payment = cls.__table__()
+        group = Group.__table__()
+        pain = Pain.__table__()
+        number = Number.__table__()
+        country = Country.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_dates in grouped_slice(sorted(dates)):
+            cursor.execute(
+                *payment.join(group, condition=payment.group == group.id)
+                .join(number, condition=group.account_number == number.id)
+                .join(pain, 'LEFT', condition=group.pain == pain.id)
+                .join(country, 'LEFT', condition=pain.country_subset == country.id)
+                .select(
+                    payment.id,
+                    payment.sepa_end_to_end_id,
+                    cls.amount.sql_column(payment),
+                    payment.date,
+                    payment.state,
+                    pain.subset,
+                    country.code,
+                    where=(number.number_compact == account)
+                    & payment.date.in_(list(sub_dates))
+                    & payment.state.in_(['processing', 'succeeded']),
+                )
+            )
+            rows = cursor.fetchall()
+            # The end to end ids sent were converted with the subset of their message
+            subsets = {}
+            for row in rows:
+                if row[5]:
+                    subsets.setdefault(row[6], []).append(row[1])
+            sent_ids = {code: sepadecode.sepa_conversions(code, ids) for code, ids in subsets.items()}
+            for id_, end_to_end_id, amount, date, state, subset, code in rows:
+                if not isinstance(amount, Decimal):
+                    # SQLite returns numeric as float
+                    amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+                if subset:
+                    end_to_end_id = sent_ids[code][end_to_end_id]
+                if end_to_end_id:
+                    end_to_end_id = end_to_end_id[:35]
+                index.setdefault((end_to_end_id, amount, date, account), []).append([id_, state])
+
+    @classmethod
+    def _reconcile_sepa_lines(cls, index, loaded, unmatched, lines):
+        '''Match a chunk of statement lines and update the state of their payments
+
+        The payments of the accounts are loaded only for the dates of the
+        lines, loaded holds the (account, date) already in index.
+        '''
+        payment = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        dates = {}
+        for line in lines:
+            account = iban.compact(line.account) if line.account else None
+            if line.date and (account, line.date) not in loaded:
+                dates.setdefault(account, set()).add(line.date)
+        for account, account_dates in dates.items():
+            cls._load_sepa_reconciliation_index(index, account, account_dates)
+            loaded.update((account, date) for date in account_dates)
+
+        ids = {'succeeded': [], 'failed': []}
+        for line in lines:
+            account = iban.compact(line.account) if line.account else None
+            payments = index.get((line.end_to_end_id, line.amount, line.date, account))
+            if not payments or not (line.credit or line.returned):
+                unmatched.append(line)
+                continue
+            if line.returned:
+                state, from_states = 'failed', ('processing', 'succeeded')
+            else:
+                state, from_states = 'succeeded', ('processing',)
+            for record in payments:
+                if record[1] in from_states:
+                    ids[state].append(record[0])
+                    record[1] = state
+                    break
+
+        for state, state_ids in ids.items():
+            for sub_ids in grouped_slice(state_ids):
+                cursor.execute(
+                    *payment.update(columns=[payment.state], values=[state], where=reduce_ids(payment.id, sub_ids))
+                )
+
+
+# Read-only snapshots of the records rendered in the messages
+SepaCurrency = namedtuple('SepaCurrency', ['id', 'code'])
+SepaBank = namedtuple('SepaBank', ['id', 'bic', 'party'])
+SepaAccount = namedtuple('SepaAccount', ['bank', 'currency'])
+SepaAccountNumber = namedtuple('SepaAccountNumber', ['id', 'compact_iban', 'account'])
+SepaCompany = namedtuple('SepaCompany', ['id', 'party', 'sepa_creditor_identifier'])
+SepaMandate = namedtuple('SepaMandate', ['id', 'identification', 'signature_date', 'scheme', 'party', 'account_number'])
+SepaBatch = namedtuple('SepaBatch', ['key', 'payments', 'nboftxs', 'ctrlsum'])
+SepaBatchPlan = namedtuple('SepaBatchPlan', ['batches', 'nboftxs', 'ctrlsum'])
+# data is the gzip compressed message, payment_ids the payments of a split message
+SepaMessage = namedtuple('SepaMessage', ['data', 'nboftxs', 'ctrlsum', 'message_id', 'payment_ids'])
+SepaGroup = namedtuple(
+    'SepaGroup',
+    ['id', 'reference', 'company', 'account_number', 'date', 'sepa_batch_booking', 'sepa_charge_bearer'],
+)
+
+
+class SepaParty(namedtuple('SepaParty', ['id', 'name'])):
+    __slots__ = ()
+
+    def address_get(self, type=None):
+        # Postal addresses are seldom rendered so they are not prefetched
+        Party = Pool().get('party.party')
+        return Party(self.id).address_get(type=type)
+
+
+class SepaPayment(
+    namedtuple(
+        'SepaPayment',
+        [
+            'id',
+            'group',
+            'amount',
+            'currency',
+            'mandate',
+            'sepa_end_to_end_id',
+            'description',
+            'date',
+            'type',
+            'debtor',
+        ],
+    )
+):
+    __slots__ = ()
+    sequence_type = Payment.sequence_type
+
+
+# groups maps the group ids to their snapshot
+SepaPain = namedtuple('SepaPain', ['id', 'reference', 'company', 'groups', 'subset', 'country_subset'])
+
+
+def _sepa_account_number_columns(number, bank, party, currency):
+    return [number.id, number.number, number.type, bank.id, bank.bic, party.id, party.name, currency.id, currency.code]
+
+
+def _sepa_account_number(row):
+    'Return the account number snapshot from the _sepa_account_number_columns values'
+    number_id, number, type_, bank_id, bic, party_id, name, currency_id, code = row
+    return SepaAccountNumber(
+        number_id,
+        iban.compact(number) if type_ == 'iban' else number,
+        SepaAccount(SepaBank(bank_id, bic, SepaParty(party_id, name)), SepaCurrency(currency_id, code) if currency_id else None),
+    )
+
 
 class Mandate(Workflow, ModelSQL, ModelView):
     'Condominium SEPA Mandate'
@@ -1028,16 +2506,12 @@ class Mandate(Workflow, ModelSQL, ModelView):
     @staticmethod
     def default_type():
         Configuration = Pool().get('condo.payment.sepa.mandate.configuration')
-        config = Configuration(1)
-        if config.type:
-            return config.type
+        return Configuration.get_defaults()['type']
 
     @staticmethod
     def default_scheme():
         Configuration = Pool().get('condo.payment.sepa.mandate.configuration')
-        config = Configuration(1)
-        if config.scheme:
-            return config.scheme
+        return Configuration.get_defaults()['scheme']
 
     @staticmethod
     def default_state():
@@ -1249,3 +2723,185 @@ class CheckMandates(Wizard):
 
     def default_result(self, fields):
         return {'mandates': [p.id for p in self.result.mandates], 'units': [p.id for p in self.result.units]}
+
+
+class ImportStatusReportStart(ModelView):
+    'Import Status Report'
+    __name__ = 'condo.payment.pain.import_status.start'
+    report = fields.Binary('Status Report', required=True, help='The pain.002 file sent back by the bank.')
+
+
+class ImportStatusReport(Wizard):
+    'Import Status Report'
+    __name__ = 'condo.payment.pain.import_status'
+    start = StateView(
+        'condo.payment.pain.import_status.start',
+        'condominium_payment_sepa.import_status_start_view_form',
+        [Button('Cancel', 'end', 'tryton-cancel'), Button('Import', 'import_', 'tryton-ok', default=True)],
+    )
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        Pain = Pool().get('condo.payment.pain')
+        pain = Pain(Transaction().context['active_id'])
+        pain.import_sepa_status_report(BytesIO(self.start.report))
+        return 'end'
+
+
+class ReconcileStatementsStart(ModelView):
+    'Reconcile Bank Statements'
+    __name__ = 'condo.payment.reconcile.start'
+    statements = fields.Binary(
+        'Statements', required=True, help='A camt.053 or camt.054 file or a ZIP archive of them.'
+    )
+
+
+class ReconcileStatementsResult(ModelView):
+    'Reconcile Bank Statements'
+    __name__ = 'condo.payment.reconcile.result'
+    unmatched = fields.Integer('Unmatched Lines', readonly=True)
+    report = fields.Binary('Report', filename='report_name', readonly=True)
+    report_name = fields.Char('Report Name', readonly=True)
+
+
+class ReconcileStatements(Wizard):
+    'Reconcile Bank Statements'
+    __name__ = 'condo.payment.reconcile'
+    start = StateView(
+        'condo.payment.reconcile.start',
+        'condominium_payment_sepa.reconcile_start_view_form',
+        [Button('Cancel', 'end', 'tryton-cancel'), Button('Reconcile', 'reconcile', 'tryton-ok', default=True)],
+    )
+    reconcile = StateTransition()
+    result = StateView(
+        'condo.payment.reconcile.result',
+        'condominium_payment_sepa.reconcile_result_view_form',
+        [Button('Close', 'end', 'tryton-close', default=True)],
+    )
+
+    def get_sources(self):
+        'Yield the name and file of each statement of the uploaded data'
+        data = BytesIO(self.start.statements)
+        if zipfile.is_zipfile(data):
+            with zipfile.ZipFile(data) as archive:
+                for name in archive.namelist():
+                    if not name.endswith('/'):
+                        with archive.open(name) as source:
+                            yield name, source
+        else:
+            data.seek(0)
+            yield 'statement', data
+
+    def transition_reconcile(self):
+        Payment = Pool().get('condo.payment')
+        self._unmatched = Payment.reconcile_sepa_statements(self.get_sources())
+        return 'result'
+
+    def default_result(self, fields):
+        report = StringIO()
+        writer = csv.writer(report)
+        writer.writerow(['Account', 'Date', 'Amount', 'Currency', 'Type', 'Returned', 'End To End ID', 'Reference'])
+        for line in self._unmatched:
+            writer.writerow(
+                [
+                    line.account or '',
+                    line.date.isoformat() if line.date else '',
+                    line.amount,
+                    line.currency or '',
+                    'CRDT' if line.credit else 'DBIT',
+                    'yes' if line.returned else '',
+                    line.end_to_end_id or '',
+                    line.reference or '',
+                ]
+            )
+        return {
+            'unmatched': len(self._unmatched),
+            'report': report.getvalue().encode('utf-8'),
+            'report_name': 'unmatched.csv',
+        }
+
+
+class FeeRunStart(ModelView):
+    'Fee Run'
+    __name__ = 'condo.payment.fee_run.start'
+    companies = fields.Many2Many(
+        'company.company',
+        None,
+        None,
+        'Condominiums',
+        domain=[('party.active', '=', True), ('is_condo', '=', True)],
+        required=True,
+    )
+    reference = fields.Char('Reference', required=True)
+    date = fields.Date('Debit Date', required=True)
+    amount_rule = fields.Selection(
+        [('fixed', 'Fixed Amount'), ('last', 'Last Amount')],
+        'Amount Rule',
+        required=True,
+        sort=False,
+        help='Debit the same amount to every unit or the last amount debited to the unit with the mandate.',
+    )
+    amount = fields.Numeric(
+        'Amount',
+        digits=(11, 2),
+        depends=['amount_rule'],
+        states={'required': Eval('amount_rule') == 'fixed'},
+        help='With Last Amount, the amount debited to the units without previous payment with the mandate.',
+    )
+    description = fields.Char('Description', size=140)
+    sepa_batch_booking = fields.Boolean('Batch Booking')
+    sepa_charge_bearer = fields.Selection(
+        [('DEBT', 'Debtor'), ('CRED', 'Creditor'), ('SHAR', 'Shared'), ('SLEV', 'Service Level')],
+        'Charge Bearer',
+        required=True,
+        sort=False,
+    )
+
+    @staticmethod
+    def default_companies():
+        context = Transaction().context
+        if context.get('active_model') == 'company.company':
+            return context.get('active_ids')
+
+    @staticmethod
+    def default_amount_rule():
+        return 'fixed'
+
+    @staticmethod
+    def default_sepa_batch_booking():
+        return Pool().get('condo.payment.group').default_sepa_batch_booking()
+
+    @staticmethod
+    def default_sepa_charge_bearer():
+        return Pool().get('condo.payment.group').default_sepa_charge_bearer()
+
+
+class FeeRun(Wizard):
+    'Fee Run'
+    __name__ = 'condo.payment.fee_run'
+    start = StateView(
+        'condo.payment.fee_run.start',
+        'condominium_payment_sepa.fee_run_start_view_form',
+        [Button('Cancel', 'end', 'tryton-cancel'), Button('Create', 'create_', 'tryton-ok', default=True)],
+    )
+    create_ = StateAction('condominium_payment_sepa.act_condopaymentgroup_form')
+
+    def do_create_(self, action):
+        Group = Pool().get('condo.payment.group')
+        groups = Group.create_fee_run(
+            self.start.companies,
+            {
+                'reference': self.start.reference,
+                'date': self.start.date,
+                'sepa_batch_booking': self.start.sepa_batch_booking,
+                'sepa_charge_bearer': self.start.sepa_charge_bearer,
+            },
+            self.start.amount_rule,
+            amount=self.start.amount,
+            description=self.start.description,
+        )
+        action['pyson_domain'] = PYSONEncoder().encode([('id', 'in', [g.id for g in groups])])
+        return action, {}
+
+    def transition_create_(self):
+        return 'end'
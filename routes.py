@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    GNU Condo: The Free Management Condominium System
+#    Copyright (C) 2016- M. Alonso <port02.server@gmail.com>
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+'''Download of the generated pain messages
+
+The pains are read in the request transaction. Their compressed messages
+are then read from the filestore one by one while the response is sent,
+decompressed by chunks, so at most one compressed message is in memory.
+'''
+
+import zipfile
+from functools import wraps
+
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import abort
+from werkzeug.wrappers import Response
+
+from trytond.filestore import filestore
+from trytond.protocols.wrappers import with_pool, with_transaction
+from trytond.transaction import Transaction
+from trytond.wsgi import app
+
+from .payment import iter_decompress_message
+
+
+class _Buffer(object):
+    'Unseekable sink collecting the bytes written by ZipFile'
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _iter_message(file_id, prefix):
+    return iter_decompress_message(filestore.get(file_id, prefix=prefix))
+
+
+def _iter_zip(files):
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, file_id, prefix in files:
+            with archive.open(name, 'w') as entry:
+                for chunk in _iter_message(file_id, prefix):
+                    entry.write(chunk)
+                    yield from buffer.pop()
+            yield from buffer.pop()
+    yield from buffer.pop()
+
+
+def with_user(func):
+    'Abort unless the request has a valid session, checked outside of the request transaction'
+
+    @wraps(func)
+    def wrapper(request, pool, *args, **kwargs):
+        if not request.user_id:
+            abort(401)
+        return func(request, pool, *args, **kwargs)
+
+    return wrapper
+
+
+def _get_files(request, pool, ids):
+    'Return the name and the message files of the pains of ids readable by the user'
+    Pain = pool.get('condo.payment.pain')
+    transaction = Transaction()
+    with transaction.set_user(request.user_id), transaction.set_context(_check_access=True):
+        pains = Pain.search([('id', 'in', ids)], order=[('id', 'ASC')])
+        if len(pains) != len(set(ids)):
+            abort(404)
+        return [(pain.reference.replace('/', '-'), pain.get_message_files()) for pain in pains]
+
+
+def _send(body, filename, mimetype):
+    headers = Headers()
+    headers.add('Content-Disposition', 'attachment', filename=filename)
+    return Response(body, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+
+@app.route('/<database_name>/condominium_payment_sepa/pain/<int:pain_id>', methods=['GET'])
+@with_pool
+@with_user
+@with_transaction()
+def pain_message(request, pool, pain_id):
+    (name, files), = _get_files(request, pool, [pain_id])
+    if not files:
+        abort(404)
+    elif len(files) == 1:
+        filename, file_id, prefix = files[0]
+        return _send(_iter_message(file_id, prefix), filename, 'application/xml')
+    # Split messages
+    return _send(_iter_zip(files), '%s.zip' % name, 'application/zip')
+
+
+@app.route('/<database_name>/condominium_payment_sepa/pains.zip', methods=['GET'])
+@with_pool
+@with_user
+@with_transaction()
+def pain_messages(request, pool):
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        abort(400)
+    files = [f for _, pain_files in _get_files(request, pool, ids) for f in pain_files]
+    if not files:
+        abort(404)
+    return _send(_iter_zip(files), 'pains.zip', 'application/zip')
@@ -1049,22 +1049,60 @@ _by_code = _build_index(1)
 _countries = set([c for r in _records if r[3] for c in r[3]])
 
 
+# Characters allowed as is by the ISO20022 Unicode Character Subset
+_allowed = ' ()+,-./0123456789:?ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+class _Table(dict):
+    "str.translate table mapping every unknown code point to '.'"
+
+    def __missing__(self, key):
+        return '.'
+
+
+# Translation tables by country code, built on first use
+_tables = {}
+
+
+def _build_table(country):
+    table = _Table.fromkeys(range(0x0460), '.')
+    for c, code, replacement, countries in _records:
+        if 0x0460 <= code <= 0x20AB or code >= 0x20AD:
+            continue
+        table[code] = c if country in countries else replacement
+    for c in _allowed:
+        table[ord(c)] = c
+    return table
+
+
+def _get_table(country):
+    if not country or country not in _countries:
+        country = None
+    table = _tables.get(country)
+    if table is None:
+        table = _tables[country] = _build_table(country)
+    return table
+
+
 def sepa_conversion(country: str, s: str) -> str:
-    result = ''
-    for c in s:
-        if c in ' ()+,-./0123456789:?ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz':
-            result += c
-        elif ord(c) >= int('0460', 16) and ord(c) <= int('20ab', 16):
-            result += '.'
-        elif ord(c) >= int('20ad', 16):
-            result += '.'
+    return s.translate(_get_table(country))
+
+
+def sepa_conversions(country: str, values) -> dict:
+    '''Convert an iterable of strings or of (key, string) pairs
+
+    Return a dictionary with the converted string by key, plain strings
+    being their own key. Each distinct string is converted only once.
+    '''
+    table = _get_table(country)
+    converted = {}
+    result = {}
+    for value in values:
+        if isinstance(value, tuple):
+            key, s = value
         else:
-            conversion = _by_code.get(ord(c))
-            if conversion:
-                if country and country in conversion[3]:
-                    result += c
-                else:
-                    result += conversion[2]
-            else:
-                result += '.'
+            key = s = value
+        if s and s not in converted:
+            converted[s] = s.translate(table)
+        result[key] = converted.get(s, s)
     return result
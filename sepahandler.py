@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    GNU Condo: The Free Management Condominium System
+#    Copyright (C) 2016- M. Alonso <port02.server@gmail.com>
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+'''Streaming readers of the reports sent back by the banks
+
+They handle each element of the report as soon as it is parsed and then
+drop it, so the memory used does not depend on the number of transactions.
+'''
+
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from lxml import etree
+
+__all__ = [
+    'SEPAHandler',
+    'PAIN002',
+    'CAMT',
+    'TransactionStatus',
+    'StatementLine',
+    'read_message_id',
+    'REJECTED',
+    'ACCEPTED',
+    'PARTIALLY_ACCEPTED',
+]
+
+# Status codes of the ISO 20022 external status code list
+REJECTED = 'RJCT'
+PARTIALLY_ACCEPTED = 'PART'
+ACCEPTED = frozenset(['ACCP', 'ACSC', 'ACSP', 'ACWC'])
+
+TransactionStatus = namedtuple(
+    'TransactionStatus', ['end_to_end_id', 'payment_information_id', 'mandate_identification', 'status']
+)
+
+StatementLine = namedtuple(
+    'StatementLine',
+    ['account', 'date', 'amount', 'currency', 'credit', 'returned', 'end_to_end_id', 'reference'],
+)
+
+
+def release(element):
+    'Clear the handled element and drop its already handled siblings'
+    element.clear()
+    parent = element.getparent()
+    previous = element.getprevious()
+    while previous is not None and previous.tag == element.tag:
+        parent.remove(previous)
+        previous = element.getprevious()
+
+
+def read_message_id(source):
+    'Return the MsgId of the message read from source, parsed only up to it'
+    for _, element in etree.iterparse(source, tag='{*}MsgId'):
+        return element.text
+
+
+class SEPAHandler(object):
+    def __init__(self, source):
+        for event, element in etree.iterparse(source):
+            self.handle(event, element)
+
+    def handle(self, event, element):
+        'Handle the element once parsed, to be defined by each handler'
+
+
+class PAIN002(SEPAHandler):
+    '''Customer payment status report
+
+    The statuses of the transactions are passed by chunks of size to
+    handle_transactions with the id of the original message while the
+    statuses of the original message and of its payment information blocks
+    are kept on the handler.
+    '''
+
+    message_id = None
+    group_status = None
+
+    def __init__(self, source, handle_transactions, size=1000):
+        self.handle_transactions = handle_transactions
+        self.size = size
+        self.payment_information = {}
+        self._payment_information_id = None
+        self._transactions = []
+        super(PAIN002, self).__init__(source)
+        self.flush()
+
+    def handle(self, event, element):
+        tag = etree.QName(element)
+        if tag.localname == 'OrgnlGrpInfAndSts':
+            self.message_id = element.findtext('./{%s}OrgnlMsgId' % tag.namespace)
+            self.group_status = element.findtext('./{%s}GrpSts' % tag.namespace)
+            release(element)
+        elif tag.localname == 'OrgnlPmtInfId':
+            # Comes before the transactions of its block
+            self._payment_information_id = element.text
+        elif tag.localname == 'TxInfAndSts':
+            self.handle_transaction(element)
+            release(element)
+        elif tag.localname == 'OrgnlPmtInfAndSts':
+            status = element.findtext('./{%s}PmtInfSts' % tag.namespace)
+            if status:
+                self.payment_information[self._payment_information_id] = status
+            self._payment_information_id = None
+            release(element)
+
+    def handle_transaction(self, element):
+        ns = etree.QName(element).namespace
+        status = element.findtext('./{%s}TxSts' % ns)
+        end_to_end_id = element.findtext('./{%s}OrgnlEndToEndId' % ns)
+        if not status or not end_to_end_id:
+            return
+        self._transactions.append(
+            TransactionStatus(
+                end_to_end_id,
+                self._payment_information_id,
+                element.findtext('./{%(ns)s}OrgnlTxRef/{%(ns)s}MndtRltdInf/{%(ns)s}MndtId' % {'ns': ns}),
+                status,
+            )
+        )
+        if len(self._transactions) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._transactions:
+            self.handle_transactions(self.message_id, self._transactions)
+            self._transactions = []
+
+
+def _date(text):
+    'Return the date of an ISO date or datetime'
+    return datetime.datetime.strptime(text[:10], '%Y-%m-%d').date() if text else None
+
+
+class CAMT(SEPAHandler):
+    '''Bank to customer statement (camt.053) or notification (camt.054)
+
+    The transactions of the booked entries are passed as StatementLine by
+    chunks of size to handle_lines. An entry without details is passed as
+    one line without end to end id.
+    '''
+
+    def __init__(self, source, handle_lines, size=1000):
+        self.handle_lines = handle_lines
+        self.size = size
+        self._account = None
+        self._lines = []
+        super(CAMT, self).__init__(source)
+        self.flush()
+
+    def handle(self, event, element):
+        tag = etree.QName(element)
+        if tag.localname == 'Acct' and etree.QName(element.getparent()).localname in ('Stmt', 'Ntfctn'):
+            # Comes before the entries of its statement
+            self._account = element.findtext('./{%(ns)s}Id/{%(ns)s}IBAN' % {'ns': tag.namespace}) or element.findtext(
+                './{%(ns)s}Id/{%(ns)s}Othr/{%(ns)s}Id' % {'ns': tag.namespace}
+            )
+        elif tag.localname == 'Ntry':
+            self.handle_entry(element)
+            release(element)
+        elif tag.localname in ('Stmt', 'Ntfctn'):
+            self._account = None
+            release(element)
+
+    def handle_entry(self, element):
+        ns = {'c': etree.QName(element).namespace}
+        status = element.findtext('./c:Sts/c:Cd', namespaces=ns) or element.findtext('./c:Sts', namespaces=ns)
+        if (status or '').strip() != 'BOOK':
+            return
+        credit = element.findtext('./c:CdtDbtInd', namespaces=ns) == 'CRDT'
+        date = _date(
+            element.findtext('./c:ValDt/c:Dt', namespaces=ns)
+            or element.findtext('./c:ValDt/c:DtTm', namespaces=ns)
+            or element.findtext('./c:BookgDt/c:Dt', namespaces=ns)
+            or element.findtext('./c:BookgDt/c:DtTm', namespaces=ns)
+        )
+        reference = element.findtext('./c:AcctSvcrRef', namespaces=ns) or element.findtext('./c:NtryRef', namespaces=ns)
+        entry_amount = element.find('./c:Amt', namespaces=ns)
+
+        details = element.findall('./c:NtryDtls/c:TxDtls', namespaces=ns)
+        if not details:
+            self.add_line(
+                StatementLine(
+                    self._account,
+                    date,
+                    Decimal(entry_amount.text),
+                    entry_amount.get('Ccy'),
+                    credit,
+                    False,
+                    None,
+                    reference,
+                )
+            )
+        for transaction in details:
+            for path in ('./c:AmtDtls/c:InstdAmt/c:Amt', './c:AmtDtls/c:TxAmt/c:Amt', './c:Amt'):
+                amount = transaction.find(path, namespaces=ns)
+                if amount is not None:
+                    break
+            else:
+                amount = entry_amount
+            returned = transaction.find('./c:RtrInf', namespaces=ns) is not None
+            transaction_date = date
+            if returned:
+                # A return is booked after the collection it returns
+                transaction_date = (
+                    _date(transaction.findtext('./c:RltdDts/c:IntrBkSttlmDt', namespaces=ns)) or date
+                )
+            indicator = transaction.findtext('./c:CdtDbtInd', namespaces=ns)
+            end_to_end_id = transaction.findtext('./c:Refs/c:EndToEndId', namespaces=ns)
+            self.add_line(
+                StatementLine(
+                    self._account,
+                    transaction_date,
+                    Decimal(amount.text),
+                    amount.get('Ccy'),
+                    indicator == 'CRDT' if indicator else credit,
+                    returned,
+                    end_to_end_id if end_to_end_id != 'NOTPROVIDED' else None,
+                    transaction.findtext('./c:Refs/c:AcctSvcrRef', namespaces=ns) or reference,
+                )
+            )
+
+    def add_line(self, line):
+        self._lines.append(line)
+        if len(self._lines) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self.handle_lines(self._lines)
+            self._lines = []
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    GNU Condo: The Free Management Condominium System
+#    Copyright (C) 2016- M. Alonso <port02.server@gmail.com>
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+'''Incremental writers of pain messages
+
+They write the same bytes as the Genshi templates of the template folder
+(comments removed) but element by element to a file-like sink, so the
+memory used does not depend on the number of payments.
+'''
+
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from decimal import Decimal
+
+from lxml import etree
+
+__all__ = ['WRITERS', 'MessageSizer', 'message_id', 'payment_information_id', 'write_pain_008_001_02']
+
+_NSMAP = {
+    'pain.008.001.02': {
+        None: 'urn:iso:std:iso:20022:tech:xsd:pain.008.001.02',
+        'xsd': 'http://www.w3.org/2001/XMLSchema',
+        'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+    }
+}
+
+# Same clean up Genshi WhitespaceFilter does on text
+_trim_trailing_space = re.compile('[ \t]+(?=\n)').sub
+_collapse_lines = re.compile('\n{2,}').sub
+
+
+class _Writer(object):
+    def __init__(self, xf, namespace):
+        self.xf = xf
+        self.namespace = namespace
+
+    def indent(self, indent):
+        self.xf.write('\n' + ' ' * indent)
+
+    @contextmanager
+    def element(self, indent, tag, attrib=None):
+        self.indent(indent)
+        with self.xf.element('{%s}%s' % (self.namespace, tag), attrib or {}):
+            yield
+            self.indent(indent)
+
+    def leaf(self, indent, tag, text, attrib=None):
+        self.indent(indent)
+        with self.xf.element('{%s}%s' % (self.namespace, tag), attrib or {}):
+            if '\n' in text:
+                text = _collapse_lines('\n', _trim_trailing_space('', text))
+            self.xf.write(text)
+
+    def party_identification(self, indent, obj, id=True, name=None):
+        self.leaf(indent, 'Nm', (name or obj.party.name)[:70])
+        if id and obj.sepa_creditor_identifier:
+            with self.element(indent, 'Id'):
+                with self.element(indent + 4, 'PrvtId'):
+                    with self.element(indent + 8, 'Othr'):
+                        self.leaf(indent + 12, 'Id', obj.sepa_creditor_identifier)
+                        with self.element(indent + 12, 'SchmeNm'):
+                            self.leaf(indent + 16, 'Prtry', 'SEPA')
+
+    def account(self, indent, account_number, currency=True):
+        with self.element(indent, 'Id'):
+            self.leaf(indent + 4, 'IBAN', account_number.compact_iban)
+        if currency and account_number.account.currency:
+            self.leaf(indent, 'Ccy', account_number.account.currency.code)
+
+    def financial_institution_bic(self, indent, bank):
+        with self.element(indent, 'FinInstnId'):
+            if bank.bic:
+                self.leaf(indent + 4, 'BIC', bank.bic)
+            else:
+                with self.element(indent + 4, 'Othr'):
+                    self.leaf(indent + 8, 'Id', 'NOTPROVIDED')
+
+
+def payment_information_id(date, sequence_type, creditor_identifier):
+    'Return the identification of the payment information block of the key'
+    return (date.strftime("%Y%m%d%H%M%S") + sequence_type + '-' + creditor_identifier)[-35:]
+
+
+def message_id(now, creditor_identifier, sequence=None):
+    'Return the identification of the message created at now, sequence numbers the split messages'
+    id_ = now.strftime("%Y%m%d%H%M%S") + "ALONS" + creditor_identifier
+    if sequence is not None:
+        id_ += '-%s' % sequence
+    return id_[-35:]
+
+
+def write_pain_008_001_02(sink, pain, plan, now, sequence=None):
+    '''Write the pain.008.001.02 message of pain to the binary sink
+
+    pain is the snapshot returned by CondoPain.get_sepa_snapshot, plan its
+    batch plan as returned by CondoPain.get_sepa_batch_plan and now the
+    creation datetime of the message. sequence is the number of the
+    message when the pain is split.
+    '''
+    nsmap = _NSMAP['pain.008.001.02']
+    sink.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+    with etree.xmlfile(sink, encoding='UTF-8') as xf:
+        w = _Writer(xf, nsmap[None])
+        with xf.element('{%s}Document' % nsmap[None], nsmap=nsmap):
+            w.indent(4)
+            with w.element(4, 'CstmrDrctDbtInitn'):
+                with w.element(8, 'GrpHdr'):
+                    w.leaf(12, 'MsgId', message_id(now, pain.company.sepa_creditor_identifier, sequence))
+                    w.leaf(12, 'CreDtTm', now.isoformat()[:19])
+                    w.leaf(12, 'NbOfTxs', str(plan.nboftxs))
+                    w.leaf(12, 'CtrlSum', '{:.2f}'.format(plan.ctrlsum))
+                    with w.element(12, 'InitgPty'):
+                        w.party_identification(20, pain.company)
+                for key, payments, nboftxs, ctrlsum in plan.batches:
+                    group = key['group']
+                    with w.element(8, 'PmtInf'):
+                        w.leaf(
+                            12,
+                            'PmtInfId',
+                            payment_information_id(
+                                key['date'], key['sequence_type'], group.company.sepa_creditor_identifier
+                            ),
+                        )
+                        w.leaf(12, 'PmtMtd', 'DD')
+                        w.leaf(12, 'BtchBookg', 'true' if group.sepa_batch_booking else 'false')
+                        w.leaf(12, 'NbOfTxs', str(nboftxs))
+                        w.leaf(12, 'CtrlSum', '{:.2f}'.format(ctrlsum))
+                        with w.element(12, 'PmtTpInf'):
+                            with w.element(16, 'SvcLvl'):
+                                w.leaf(20, 'Cd', 'SEPA')
+                            with w.element(16, 'LclInstrm'):
+                                w.leaf(20, 'Cd', key['scheme'])
+                            w.leaf(16, 'SeqTp', key['sequence_type'])
+                        w.leaf(12, 'ReqdColltnDt', key['date'].isoformat())
+                        with w.element(12, 'Cdtr'):
+                            w.party_identification(20, group.company, id=False)
+                        with w.element(12, 'CdtrAcct'):
+                            w.account(20, group.account_number)
+                        with w.element(12, 'CdtrAgt'):
+                            w.financial_institution_bic(20, group.account_number.account.bank)
+                        w.leaf(12, 'ChrgBr', group.sepa_charge_bearer)
+                        with w.element(12, 'CdtrSchmeId'):
+                            with w.element(14, 'Id'):
+                                with w.element(16, 'PrvtId'):
+                                    with w.element(18, 'Othr'):
+                                        w.leaf(20, 'Id', group.company.sepa_creditor_identifier)
+                                        with w.element(20, 'SchmeNm'):
+                                            w.leaf(23, 'Prtry', 'SEPA')
+                        for payment in payments:
+                            _write_drctdbttxinf(w, payment)
+            w.indent(0)
+
+
+def _write_drctdbttxinf(w, payment):
+    with w.element(12, 'DrctDbtTxInf'):
+        with w.element(16, 'PmtId'):
+            w.leaf(20, 'EndToEndId', payment.sepa_end_to_end_id[:35])
+        w.leaf(16, 'InstdAmt', '{:.2f}'.format(payment.amount), {'Ccy': payment.currency.code})
+        mandate = payment.mandate
+        with w.element(16, 'DrctDbtTx'):
+            with w.element(20, 'MndtRltdInf'):
+                w.leaf(24, 'MndtId', mandate.identification)
+                w.leaf(24, 'DtOfSgntr', mandate.signature_date.isoformat())
+        with w.element(16, 'DbtrAgt'):
+            w.financial_institution_bic(20, mandate.account_number.account.bank)
+        with w.element(16, 'Dbtr'):
+            w.party_identification(20, mandate, id=False, name=payment.debtor)
+        with w.element(16, 'DbtrAcct'):
+            w.account(20, mandate.account_number, currency=False)
+        if payment.description:
+            with w.element(16, 'RmtInf'):
+                w.leaf(20, 'Ustrd', payment.description[:140])
+
+
+# Streaming writer by receivable flavor
+WRITERS = {'pain.008.001.02': write_pain_008_001_02}
+_TRANSACTION_WRITERS = {'pain.008.001.02': _write_drctdbttxinf}
+
+_Plan = namedtuple('_Plan', ['batches', 'nboftxs', 'ctrlsum'])
+# Widest totals allowed by the schemas
+_MAX_NBOFTXS = 10 ** 15 - 1
+_MAX_CTRLSUM = Decimal('9' * 16 + '.99')
+
+
+class _Counter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class MessageSizer(object):
+    '''Upper bounds of the bytes written by the streaming writer of flavor
+
+    The size of a message is the envelope plus the header of each of its
+    payment information blocks plus each of its transactions.
+    '''
+
+    def __init__(self, flavor, pain, now):
+        self.flavor = flavor
+        self.pain = pain
+        self.now = now
+        self.envelope = self._message_size([])
+        self._headers = {}
+        self._root = self._transaction_size(None)
+
+    def _message_size(self, batches):
+        counter = _Counter()
+        WRITERS[self.flavor](
+            counter, self.pain, _Plan(batches, _MAX_NBOFTXS, _MAX_CTRLSUM), self.now, sequence=_MAX_NBOFTXS
+        )
+        return counter.size
+
+    def _transaction_size(self, payment):
+        nsmap = _NSMAP[self.flavor]
+        counter = _Counter()
+        with etree.xmlfile(counter, encoding='UTF-8') as xf:
+            with xf.element('{%s}Document' % nsmap[None], nsmap=nsmap):
+                if payment is not None:
+                    _TRANSACTION_WRITERS[self.flavor](_Writer(xf, nsmap[None]), payment)
+        return counter.size
+
+    def header(self, key):
+        'Return the size of the payment information block header of key'
+        cache_key = (key['date'], key['group'].id, key['sequence_type'], key['scheme'])
+        if cache_key not in self._headers:
+            self._headers[cache_key] = (
+                self._message_size([(key, [], _MAX_NBOFTXS, _MAX_CTRLSUM)]) - self.envelope
+            )
+        return self._headers[cache_key]
+
+    def transaction(self, payment):
+        'Return the size of the transaction of payment'
+        return self._transaction_size(payment) - self._root
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    GNU Condo: The Free Management Condominium System
+#    Copyright (C) 2016- M. Alonso <port02.server@gmail.com>
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import unittest
+
+from trytond.modules.condominium_payment_sepa.sepadecode import _by_code, _countries, sepa_conversion, sepa_conversions
+
+# Every code point below the Cyrillic supplement, the bounds of the ranges
+# always replaced and a few astral characters
+CHARACTERS = ''.join(
+    [chr(i) for i in range(0x0500)] + ['₫', '€', '₭', '☃', '\U0001f600', '\U0010ffff']
+)
+
+
+def reference_conversion(country, s):
+    'Convert s character by character like the implementation replaced by the translation tables'
+    result = ''
+    for c in s:
+        if c in ' ()+,-./0123456789:?ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz':
+            result += c
+        elif ord(c) >= int('0460', 16) and ord(c) <= int('20ab', 16):
+            result += '.'
+        elif ord(c) >= int('20ad', 16):
+            result += '.'
+        else:
+            conversion = _by_code.get(ord(c))
+            if conversion:
+                if country and country in conversion[3]:
+                    result += c
+                else:
+                    result += conversion[2]
+            else:
+                result += '.'
+    return result
+
+
+class SepaDecodeTestCase(unittest.TestCase):
+    'Test the conversion to the ISO20022 Unicode Character Subset'
+
+    def test_sepa_conversion(self):
+        'Test sepa_conversion gives the output of the reference conversion'
+        for country in sorted(_countries) + [None, '', 'XX']:
+            self.assertEqual(sepa_conversion(country, CHARACTERS), reference_conversion(country, CHARACTERS), country)
+
+    def test_sepa_conversions(self):
+        'Test sepa_conversions converts each value like the reference conversion'
+        values = ['Señor Pérez', ('key', 'Piso 1º'), '', CHARACTERS]
+        for country in sorted(_countries) + [None]:
+            result = sepa_conversions(country, values)
+            self.assertEqual(result['Señor Pérez'], reference_conversion(country, 'Señor Pérez'))
+            self.assertEqual(result['key'], reference_conversion(country, 'Piso 1º'))
+            self.assertEqual(result[''], '')
+            self.assertEqual(result[CHARACTERS], reference_conversion(country, CHARACTERS))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SepaDecodeTestCase))
+    return suite